@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Time-to-first-output for clifford's config-only commands.
+
+Each command runs in a fresh interpreter against a throwaway HOME holding
+config.sample, so no AWS credentials or network are needed.  Also reports
+any heavy modules (boto, paramiko, requests) a config-only command pulled
+in, which should be none.
+
+    python bench/startup.py [-n RUNS] [command ...]
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = ['bundles', 'groups', 'builds', 'projects', 'scripts', 'script_path']
+HEAVY_MODULES = ['boto', 'paramiko', 'requests']
+
+RUNNER = '''
+import sys
+from clifford.main import main
+try:
+    sys.exit(main(sys.argv[1:]))
+finally:
+    sys.stderr.write('HEAVY:%s\\n' % ','.join(m for m in {heavy!r} if m in sys.modules))
+'''.format(heavy=HEAVY_MODULES)
+
+
+def make_home():
+    home = tempfile.mkdtemp(prefix='clifford-bench-')
+    conf_dir = os.path.join(home, '.clifford')
+    os.makedirs(os.path.join(conf_dir, 'scripts'))
+    shutil.copy(os.path.join(ROOT, 'config.sample'), os.path.join(conf_dir, 'config.json'))
+    return home
+
+
+def time_command(command, home):
+    """(seconds to the first byte of output, heavy modules imported) for one run of command.
+
+    A run that exits non-zero or prints nothing raises, so an error message
+    is never timed as if it were the command.
+    """
+    path = [ROOT] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])
+    env = dict(os.environ, HOME=home, PYTHONPATH=os.pathsep.join(path), COLUMNS='120')
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', RUNNER] + command.split(' '),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    first = proc.stdout.read(1)
+    first_output = time.time() - start
+    proc.stdout.read()
+    err = proc.stderr.read().decode('utf-8', 'replace')
+    proc.wait()
+    if proc.returncode or not first:
+        raise RuntimeError('%r %s:\n%s' % (command, 'exited with status %d' % proc.returncode if proc.returncode
+                                           else 'printed nothing', err))
+    heavy = ''
+    for line in err.splitlines():
+        if line.startswith('HEAVY:'):
+            heavy = line[len('HEAVY:'):]
+    return first_output, heavy
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('commands', nargs='*', default=COMMANDS)
+    args = parser.parse_args(argv)
+
+    home = make_home()
+    try:
+        print('%-14s %10s %10s  %s' % ('command', 'min (ms)', 'median', 'heavy imports'))
+        for command in args.commands:
+            timings = []
+            heavy = ''
+            for i in range(args.runs):
+                elapsed, heavy = time_command(command, home)
+                timings.append(elapsed * 1000)
+            timings.sort()
+            print('%-14s %10.1f %10.1f  %s' % (command, timings[0], timings[len(timings) // 2], heavy or '-'))
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,8 +4,6 @@ import json
 import re
 import time
 
-import requests
-
 from commands import BaseCommand
 from main import config
 
@@ -48,11 +46,12 @@ class Reboot(BaseCommand):
 
     def take_action(self, parsed_args):
         if self.sure_check():
-            for name in parsed_args.inst_names:
-                instances = self.get_instances(name)
-                for inst in instances:
-                    self.app.stdout.write('Rebooting %s\n' % inst.tags.get('Name', inst.id))
-                    inst.reboot()
+            instances = self.get_instances(*parsed_args.inst_names)
+            for inst in instances:
+                self.app.stdout.write('Rebooting %s\n' % inst.tags.get('Name', inst.id))
+            if instances:
+                self.app.ec2_conn.reboot_instances([inst.id for inst in instances])
+                self.invalidate_instances([inst.id for inst in instances])
 
 
 class Start(BaseCommand):
@@ -66,11 +65,12 @@ class Start(BaseCommand):
 
     def take_action(self, parsed_args):
         if self.sure_check():
-            for name in parsed_args.inst_names:
-                instances = self.get_instances(name)
-                for inst in instances:
-                    self.app.stdout.write('Starting %s\n' % inst.tags.get('Name', inst.id))
-                    inst.start()
+            instances = self.get_instances(*parsed_args.inst_names)
+            for inst in instances:
+                self.app.stdout.write('Starting %s\n' % inst.tags.get('Name', inst.id))
+            if instances:
+                self.app.ec2_conn.start_instances([inst.id for inst in instances])
+                self.invalidate_instances([inst.id for inst in instances])
 
 
 class Stop(BaseCommand):
@@ -84,11 +84,12 @@ class Stop(BaseCommand):
 
     def take_action(self, parsed_args):
         if self.sure_check():
-            for name in parsed_args.inst_names:
-                instances = self.get_instances(name)
-                for inst in instances:
-                    self.app.stdout.write('Stopping %s\n' % inst.tags.get('Name', inst.id))
-                    inst.stop()
+            instances = self.get_instances(*parsed_args.inst_names)
+            for inst in instances:
+                self.app.stdout.write('Stopping %s\n' % inst.tags.get('Name', inst.id))
+            if instances:
+                self.app.ec2_conn.stop_instances([inst.id for inst in instances])
+                self.invalidate_instances([inst.id for inst in instances])
 
 
 class Terminate(BaseCommand):
@@ -102,11 +103,12 @@ class Terminate(BaseCommand):
 
     def take_action(self, parsed_args):
         if self.sure_check():
-            for name in parsed_args.inst_names:
-                instances = self.get_instances(name)
-                for inst in instances:
-                    self.app.stdout.write('Terminating %s\n' % inst.tags.get('Name', inst.id))
-                    inst.terminate()
+            instances = self.get_instances(*parsed_args.inst_names)
+            for inst in instances:
+                self.app.stdout.write('Terminating %s\n' % inst.tags.get('Name', inst.id))
+            if instances:
+                self.app.ec2_conn.terminate_instances([inst.id for inst in instances])
+                self.invalidate_instances([inst.id for inst in instances])
 
 
 class CreateImage(BaseCommand):
@@ -125,7 +127,7 @@ class CreateImage(BaseCommand):
         if instance and name and self.sure_check():
             if not desc:
                 desc = None
-            image_id = instance.create_image(name, desc)
+            image_id = self.app.ec2_conn.create_image(instance.id, name, desc)
             self.app.stdout.write('Image created: %s\n' % image_id)
 
 
@@ -134,13 +136,13 @@ class CreateSnapshot(BaseCommand):
 
     def take_action(self, parsed_args):
         all_volumes = self.app.ec2_conn.get_all_volumes()
+        attached_ids = [volume.attach_data.instance_id for volume in all_volumes if volume.attachment_state() == 'attached']
+        instances = dict((instance.id, instance) for instance in self.get_instances_by_id(attached_ids))
         volumes = []
-        instances = {}
         for volume in all_volumes:
             instance_info = ''
-            if volume.attachment_state() == 'attached':
-                instance = self.get_instance(volume.attach_data.instance_id, arg_is_id=True)
-                instances[instance.id] = instance
+            if volume.attachment_state() == 'attached' and volume.attach_data.instance_id in instances:
+                instance = instances[volume.attach_data.instance_id]
                 name = instance.tags.get('Name')
                 name = '- %s ' % name if name else ''
                 instance_info = ' - %s %s- %s' % (instance.id, name, instance.state)
@@ -149,15 +151,20 @@ class CreateSnapshot(BaseCommand):
         volume = self.question_maker('Available Volumes', 'volume', volumes)
 
         if volume.attachment_state() == 'attached':
-            instance = instances[volume.attach_data.instance_id]
+            # whether to stop it is decided on the instance's current state, never a cached one
+            instance_id = volume.attach_data.instance_id
+            instance = self.get_fresh_instances([instance_id]).get(instance_id)
+            if instance is None:
+                raise RuntimeError('Unable to find instance %s attached to %s!' % (instance_id, volume.id))
             if instance.state == 'running':
                 if not self.sure_check('This will stop the attached instance! continue? '):
                     raise RuntimeError('Aborting action!')
                 self.app.stdout.write('Stopping %s\n' % instance.tags.get('Name', instance.id))
-                instance.stop()
+                self.app.ec2_conn.stop_instances([instance.id])
+                self.invalidate_instances([instance.id])
                 time.sleep(30)
                 for i in range(3):
-                    status = instance.update()
+                    status = self.app.ec2_conn.get_only_instances(instance_ids=[instance.id])[0].state
                     if status == 'stopped':
                         break
                     self.app.stdout.write('%s...\n' % status)
@@ -292,6 +299,8 @@ class Image(BaseCommand):
                 config.save()
 
         elif parsed_args.update:
+            import requests
+
             r = requests.get('https://cloud-images.ubuntu.com/locator/ec2/releasesTable')
             txt = r.text.replace('"],\n]', '"]\n]')
             aaData = json.loads(txt)['aaData']
@@ -382,7 +391,8 @@ class Tag(BaseCommand):
             if not tag_name or tag_name == 'Name':
                 raise RuntimeError('Invalid Tag!')
 
-            instance.remove_tag(tag_name)
+            self.app.ec2_conn.delete_tags([instance.id], [tag_name])
+            self.invalidate_instances([instance.id])
 
         else:
             tag_name = raw_input('Tag (Name): ')
@@ -392,4 +402,5 @@ class Tag(BaseCommand):
             if not value:
                 raise RuntimeError('Invalid Value!')
             if self.sure_check():
-                instance.add_tag(tag_name, value)
+                self.app.ec2_conn.create_tags([instance.id], {tag_name: value})
+                self.invalidate_instances([instance.id])
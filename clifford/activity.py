@@ -3,36 +3,95 @@ import logging
 import os
 import StringIO
 import sys
+import threading
 import time
-from collections import namedtuple
-from subprocess import call
+from collections import OrderedDict, namedtuple
 
-import boto
-import paramiko
+from apt import NOTES, add_repos, apt_install, install_bundles
+from engine import remote_engine
+from query import Selector, describe
+from events import emit, line_stream
+from runlog import TAIL_LINES
+from transfer import describe_transfer, push, push_all
+from ssh import ssh_sessions
 
 
-Task = namedtuple('Task', ['build', 'image', 'instance_id', 'arg_list'])
-LaunchResult = namedtuple('LaunchResult', ['build', 'image', 'instance_ids'])
+Task = namedtuple('Task', ['build', 'image', 'instance_id', 'arg_list', 'instance'])
+Task.__new__.__defaults__ = (None,)
+LaunchResult = namedtuple('LaunchResult', ['build', 'image', 'instance_ids', 'build_name'])
+LaunchResult.__new__.__defaults__ = (None,)
 
 
-def wait_for_ok(instance_ids, time_to_wait=360):
-    waiting_time = 0
-    conn = boto.connect_ec2()
+APT_CACHE_PORT = 3142
+WHEEL_PORT = 8000
+WHEELHOUSE = '/var/cache/clifford/wheels'
+
+
+class StepFailed(RuntimeError):
+    "A step that could not finish; output is what it had to say about why."
+
+    def __init__(self, output):
+        RuntimeError.__init__(self, output)
+        self.output = output
+
+
+_local = threading.local()
+
+
+def ec2_conn():
+    "The EC2 connection for this worker thread or process, shared by every task the worker runs."
+    if getattr(_local, 'pid', None) != os.getpid():
+        import boto
+        _local.conn = boto.connect_ec2()
+        _local.pid = os.getpid()
+    return _local.conn
+
+
+def backoff(first=2, factor=1.5, longest=30):
+    "Polling intervals: short at first, then backing off to `longest` seconds."
+    delay = first
     while True:
-        sys.stdout.write('Sleeping 30 seconds...\n')
-        time.sleep(30)
-        waiting_time += 30
-        all_instances = conn.get_all_instance_status()
-        for instance in all_instances:
-            if instance.id not in instance_ids:
+        yield delay
+        delay = min(delay * factor, longest)
+
+
+def iter_ok(instance_ids, time_to_wait=360, out=sys.stdout):
+    "Yield each instance id as soon as both of its status checks pass."
+    conn = ec2_conn()
+    pending = set(instance_ids)
+    seen = {}
+    deadline = time.time() + time_to_wait
+    delays = backoff()
+    while pending:
+        for status in conn.get_all_instance_status(instance_ids=list(pending)):
+            if status.id not in pending:
                 continue
-            print instance.id, instance.system_status.status, instance.instance_status.status
-            if instance.system_status.status == 'ok' and instance.instance_status.status == 'ok':
-                instance_ids.remove(instance.id)
-        if not instance_ids:
+            checks = (status.system_status.status, status.instance_status.status)
+            if seen.get(status.id) != checks:
+                seen[status.id] = checks
+                out.write('%s %s %s\n' % ((status.id,) + checks))
+            if checks == ('ok', 'ok'):
+                pending.discard(status.id)
+                yield status.id
+        if not pending:
             break
-        if waiting_time >= time_to_wait:
+        remaining = deadline - time.time()
+        if remaining <= 0:
             raise RuntimeError('Servers not ok after %s' % time_to_wait)
+        time.sleep(min(next(delays), remaining))
+
+
+def wait_for_ok(instance_ids, time_to_wait=360, out=sys.stdout):
+    for instance_id in iter_ok(instance_ids, time_to_wait, out):
+        pass
+
+
+def wait_ready(aws_key_path, task):
+    "Pipeline step: wait for an instance to pass its status checks again, e.g. after a reboot."
+    out = StringIO.StringIO()
+    out.write('Waiting on reboot of %s\n' % task.instance_id)
+    wait_for_ok([task.instance_id], out=out)
+    return out.getvalue()
 
 
 def launcher(tag_name, aws_key_path, script_path, **kwargs):
@@ -48,7 +107,7 @@ def launcher(tag_name, aws_key_path, script_path, **kwargs):
         return
     image = kwargs['image']
 
-    conn = boto.connect_ec2()
+    conn = ec2_conn()
     aws_image = conn.get_image(image_id=image['Id'])
 
     options = {
@@ -68,56 +127,58 @@ def launcher(tag_name, aws_key_path, script_path, **kwargs):
 
     out.write('Running instance(s)\n')
     reservation = aws_image.run(**options)
-    time.sleep(15)
 
-    instances = reservation.instances
+    instance_ids = [inst.id for inst in reservation.instances]
     if 'q' in kwargs:
-        l = LaunchResult(build, image, [inst.id for inst in instances])
+        l = LaunchResult(build, image, instance_ids, kwargs.get('build_name'))
         kwargs['q'].put(l)
-    count = len(instances)
+    count = len(instance_ids)
 
-    out.write('Waiting for instance(s) to come up\n')
-    for i in range(8):
-        time.sleep(15)
-        ready = True
-        for inst in instances:
-            status = inst.update()
-            if status != 'running':
-                out.write('%s\n' % status)
-                ready = False
-                break
-        if ready:
-            out.write('Instance(s) now running\n')
-            break
+    out.write('Adding Tags to instance(s)\n')
+    if 'Suffix' in build:
+        full_name = '%s-%s' % (tag_name, build['Suffix'])
     else:
-        out.write('All instance(s) are not created equal!\n')
-        if 'out' in kwargs:
-            return
-        return out
+        full_name = tag_name
 
-    out.write('Adding Tags to instance(s)\n')
-    for idx, inst in enumerate(instances):
-        if 'Suffix' in build:
-            full_name = '%s-%s' % (tag_name, build['Suffix'])
-        else:
-            full_name = tag_name
+    tags = {'Login': image['Login']}
+    if 'project_name' in kwargs and kwargs['project_name']:
+        tags['Project'] = kwargs['project_name']
+    if 'build_name' in kwargs and kwargs['build_name']:
+        tags['Build'] = kwargs['build_name']
+    create_tags(conn, instance_ids, tags)
 
+    names = OrderedDict()
+    for idx, inst_id in enumerate(instance_ids):
         if count == 1 and 'counter' not in kwargs:
-            inst.add_tag('Name', full_name)
+            name = full_name
         else:
-            inst.add_tag('Name', '%s-%s' % (full_name, idx + 1 + kwargs.get('counter', 0)))
-
-        if 'project_name' in kwargs and kwargs['project_name']:
-            inst.add_tag('Project', kwargs['project_name'])
+            name = '%s-%s' % (full_name, idx + 1 + kwargs.get('counter', 0))
+        names.setdefault(name, []).append(inst_id)
 
-        if 'build_name' in kwargs and kwargs['build_name']:
-            inst.add_tag('Build', kwargs['build_name'])
+    for name, inst_ids in names.items():
+        create_tags(conn, inst_ids, {'Name': name})
 
-        inst.add_tag('Login', image['Login'])
+    out.write('Waiting for instance(s) to come up\n')
+    deadline = time.time() + 135
+    delays = backoff()
+    while True:
+        states = dict((inst.id, inst) for inst in describe(conn, Selector(ids=instance_ids, states=None)))
+        waiting = sorted(set(states[inst_id].state if inst_id in states else 'pending'
+                             for inst_id in instance_ids) - set(['running']))
+        if not waiting:
+            out.write('Instance(s) now running\n')
+            break
+        if time.time() >= deadline:
+            out.write('All instance(s) are not created equal!\n')
+            if 'out' in kwargs:
+                return
+            return out
+        out.write('%s\n' % ', '.join(waiting))
+        time.sleep(next(delays))
 
-    time.sleep(20)
     out.write('Instance(s) should now be running\n')
-    for inst in instances:
+    for inst_id in instance_ids:
+        inst = states[inst_id]
         if aws_key_path:
             out.write('ssh -i %s/%s.pem %s@%s\n' % (aws_key_path,
                                                     inst.key_name,
@@ -130,13 +191,45 @@ def launcher(tag_name, aws_key_path, script_path, **kwargs):
     return out
 
 
+def create_tags(conn, instance_ids, tags, time_to_wait=60):
+    "Tag freshly launched instances in one call, retrying while EC2 catches up on the new ids."
+    from boto.exception import EC2ResponseError
+
+    deadline = time.time() + time_to_wait
+    delays = backoff(first=1)
+    while True:
+        try:
+            return conn.create_tags(instance_ids, tags)
+        except EC2ResponseError as e:
+            if e.error_code != 'InvalidInstanceID.NotFound' or time.time() >= deadline:
+                raise
+            time.sleep(next(delays))
+
+
+def remote_host(aws_key_path, task, logname):
+    "The remote engine's handle on a task's instance; the build's optional Timeout bounds each step."
+    instance = task.instance
+    return remote_engine().host(instance.public_dns_name, task.image['Login'],
+                                '%s/%s.pem' % (aws_key_path, instance.key_name),
+                                timeout=task.build.get('Timeout'), log_channel=logname)
+
+
+def warning(source, line):
+    "Report a line of stderr from source as a warning event; returns it for the step's output."
+    text = 'ERROR (%s): %s' % (source, line if line.endswith('\n') else line + '\n')
+    emit('warning', text=text)
+    return text
+
+
+def host_stream(task, title):
+    "A stream callback showing a step's remote output live, under the instance's name, and logging it."
+    return line_stream(task.instance.name or task.instance_id, title)
+
+
 def add_user(aws_key_path, task):
     output = 'Running adduser on %s\n' % task.instance_id
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
     pub_key_path = task.arg_list[0]
     adduser = task.build['Adduser']
 
@@ -148,18 +241,8 @@ def add_user(aws_key_path, task):
     logger.addHandler(fh)
 
     output += 'connecting'
-    ssh = paramiko.SSHClient()
-    ssh.set_log_channel(logname)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    while True:
-        try:
-            ssh.connect(instance.public_dns_name,
-                        username=task.image['Login'],
-                        key_filename='%s/%s.pem' % (aws_key_path, instance.key_name))
-            break
-        except:
-            output += ', sleep'
-            time.sleep(60)
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
 
     output += '\n'
 
@@ -168,54 +251,49 @@ def add_user(aws_key_path, task):
     #if 'Group' in adduser:
     #    cmd += ' --ingroup %s' % adduser['Group']
     cmd += ' --gecos "%s" %s' % (adduser['FullName'], adduser['User'])
-    stdin, stdout, stderr = ssh.exec_command(cmd)
-    for line in stderr.readlines():
-        output += 'ERROR (adduser): %s\n' % line
+    result = host.run(cmd)
+    for line in result.stderr:
+        output += warning('adduser', line)
 
     keys = glob.glob('%s/*.pub' % pub_key_path)
 
     if keys:
         user = adduser['User']
-        stdin, stdout, stderr = ssh.exec_command(
+        result = host.run(
                 'sudo su -c "mkdir /home/%(user)s/.ssh && chown %(user)s:%(user)s /home/%(user)s/.ssh && chmod 700 /home/%(user)s/.ssh"' % {'user': user})
-        for line in stderr.readlines():
-            output += 'ERROR (mkdir): %s\n' % line
+        for line in result.stderr:
+            output += warning('mkdir', line)
 
         contents = ''
         for key in keys:
             with open(key, 'r') as f:
                 contents += f.read()
 
-        stdin, stdout, stderr = ssh.exec_command('sudo su -c "cat << EOF > /home/%s/.ssh/authorized_keys\n%sEOF"' % (user, contents))
-        for line in stderr.readlines():
-            output += 'ERROR (cat): %s\n' % line
+        result = host.run('sudo su -c "cat << EOF > /home/%s/.ssh/authorized_keys\n%sEOF"' % (user, contents))
+        for line in result.stderr:
+            output += warning('cat', line)
 
-        stdin, stdout, stderr = ssh.exec_command(
+        result = host.run(
                 'sudo su -c "chown %(user)s:%(user)s /home/%(user)s/.ssh/authorized_keys; chmod 600 /home/%(user)s/.ssh/authorized_keys"' % {'user': user})
-        for line in stderr.readlines():
-            output += 'ERROR (authorized_keys): %s\n' % line
+        for line in result.stderr:
+            output += warning('authorized_keys', line)
 
     if 'CopyFiles' in adduser:
         for item in adduser['CopyFiles']:
-            with open(os.path.expanduser(item['From']), 'r') as f:
-                contents = f.read()
-                stdin, stdout, stderr = ssh.exec_command('sudo su -c "cat << EOF > %s\n%sEOF" %s' % (item['To'], contents, user))
-                for line in stderr.readlines():
-                    output += 'ERROR (copy): %s\n' % line
+            try:
+                output += describe_transfer(push(host, os.path.expanduser(item['From']), item['To'], owner=adduser['User']))
+            except (IOError, OSError, RuntimeError) as e:
+                output += warning('copy', str(e))
 
     #TODO: still need to be able to run a script as the new user
 
-    ssh.close()
     return output
 
 
 def copier(aws_key_path, task):
     output = 'Running Copier on %s\n' % task.instance_id
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
 
     output += 'logger, '
     logname = 'copier.%s' % instance.id
@@ -224,27 +302,21 @@ def copier(aws_key_path, task):
     fh = logging.FileHandler('/tmp/copier_%s.log' % instance.id)
     logger.addHandler(fh)
 
-    output += 'copying\n'
+    output += 'connecting'
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
+    output += '\ncopying\n'
 
-    file_name = task.arg_list[0]
+    for transfer in push_all(host, task.arg_list[0].split()):
+        output += describe_transfer(transfer)
 
-    try:
-        retcode = call('scp -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -i %s/%s.pem %s %s@%s:~' % (aws_key_path, instance.key_name, file_name, task.image['Login'], instance.public_dns_name), shell=True)
-        if retcode < 0:
-            output += 'Child was terminated by signal %s\n' % -retcode
-        else:
-            output += 'Child returned %s\n' % retcode
-    except OSError as e:
-        output += 'Execution failed: %s\n' % e
+    return output
 
 
 def elastic_ip(aws_key_path, task):
     output = 'Running elastic_ip on %s\n' % task.instance_id
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
     elasticip = task.build['ElasticIP']
 
     output += 'logger, '
@@ -255,20 +327,12 @@ def elastic_ip(aws_key_path, task):
     logger.addHandler(fh)
 
     output += 'connecting'
-    ssh = paramiko.SSHClient()
-    ssh.set_log_channel(logname)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    while True:
-        try:
-            ssh.connect(instance.public_dns_name, username=task.image['Login'], key_filename='%s/%s.pem' % (aws_key_path, instance.key_name))
-            break
-        except:
-            output += ', sleep'
-            time.sleep(60)
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
 
     output += '\nUpdating /etc/hosts and setting Hostname.\n'
 
-    addresses = [address for address in conn.get_all_addresses() if not address.instance_id]
+    addresses = [address for address in ec2_conn().get_all_addresses() if not address.instance_id]
     #addresses = [address.public_ip for address in addresses]
     for address in addresses:
         if elasticip['IP'] == address.public_ip:
@@ -278,34 +342,100 @@ def elastic_ip(aws_key_path, task):
         output += 'Address not available\n'
         return output
 
-    stdin, stdout, stderr = ssh.exec_command('sudo su -c "echo \'\n### CLIFFORD\n127.0.0.1\t%s\n%s\t%s\t%s\' >> /etc/hosts"' % (elasticip['Hostname'], elasticip['IP'], elasticip['FQDN'], elasticip['Hostname']))
-    for line in stderr.readlines():
-        output += 'ERROR (elasticip): %s\n' % line
+    result = host.run('sudo su -c "echo \'\n### CLIFFORD\n127.0.0.1\t%s\n%s\t%s\t%s\' >> /etc/hosts"' % (elasticip['Hostname'], elasticip['IP'], elasticip['FQDN'], elasticip['Hostname']))
+    for line in result.stderr:
+        output += warning('elasticip', line)
 
-    stdin, stdout, stderr = ssh.exec_command('sudo su -c "echo \'%s\' > /etc/hostname"' % elasticip['Hostname'])
-    for line in stderr.readlines():
-        output += 'ERROR (elasticip): %s\n' % line
+    result = host.run('sudo su -c "echo \'%s\' > /etc/hostname"' % elasticip['Hostname'])
+    for line in result.stderr:
+        output += warning('elasticip', line)
 
-    stdin, stdout, stderr = ssh.exec_command('sudo hostname -F /etc/hostname')
-    for line in stderr.readlines():
-        output += 'ERROR (elasticip): %s\n' % line
+    result = host.run('sudo hostname -F /etc/hostname')
+    for line in result.stderr:
+        output += warning('elasticip', line)
 
-    time.sleep(5)
     #output += 'Rebooting...\n'
     #instance.reboot()
     #time.sleep(60)
 
-    ssh.close()
+    return output
+
+
+def set_proxies(host, address):
+    "Point apt at the apt-cacher-ng on address, and pip at the wheels it serves."
+    result = host.run('echo \'Acquire::http::Proxy "http://%s:%s";\' | sudo tee /etc/apt/apt.conf.d/01clifford-proxy' % (address, APT_CACHE_PORT))
+    errors = result.stderr
+    if address != 'localhost':
+        result = host.run('printf \'[global]\\nfind-links = http://%s:%s/\\ntrusted-host = %s\\n\' | sudo tee /etc/pip.conf' % (address, WHEEL_PORT, address))
+        errors += result.stderr
+    return errors
+
+
+def cache_server(aws_key_path, task):
+    output = 'Running cache server on %s\n' % task.instance_id
+
+    instance = task.instance
+
+    output += 'logger, '
+    logname = 'cache_server.%s' % instance.id
+    logger = logging.getLogger(logname)
+    logger.setLevel(logging.ERROR)
+    fh = logging.FileHandler('/tmp/cache_server_%s.log' % instance.id)
+    logger.addHandler(fh)
+
+    output += 'connecting'
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
+    output += '\n'
+
+    result = apt_install(host, 'apt-cacher-ng')
+    for line in result.stderr:
+        if line.startswith('E: '):
+            output += line
+    if result.status:
+        raise StepFailed(output + 'Unable to install apt-cacher-ng!\n')
+
+    for line in set_proxies(host, 'localhost'):
+        output += warning('proxy', line)
+
+    result = host.run('sudo mkdir -p %(dir)s && cd %(dir)s && (nohup python -m SimpleHTTPServer %(port)s < /dev/null > /dev/null 2>&1 &)'
+                      % {'dir': WHEELHOUSE, 'port': WHEEL_PORT})
+    for line in result.stderr:
+        output += warning('wheels', line)
+
+    output += 'Serving apt on %s and wheels on %s\n' % (APT_CACHE_PORT, WHEEL_PORT)
+    return output
+
+
+def cache_client(aws_key_path, task):
+    output = 'Running cache client on %s\n' % task.instance_id
+
+    instance = task.instance
+    address = task.arg_list[0]
+
+    output += 'logger, '
+    logname = 'cache_client.%s' % instance.id
+    logger = logging.getLogger(logname)
+    logger.setLevel(logging.ERROR)
+    fh = logging.FileHandler('/tmp/cache_client_%s.log' % instance.id)
+    logger.addHandler(fh)
+
+    output += 'connecting'
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
+    output += '\n'
+
+    for line in set_proxies(host, address):
+        output += warning('proxy', line)
+
+    output += 'Using package cache on %s\n' % address
     return output
 
 
 def group_installer(aws_key_path, task):
     output = 'Running Group Installer on %s\n' % task.instance_id
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
 
     output += 'logger, '
     logname = 'group_installer.%s' % instance.id
@@ -315,52 +445,39 @@ def group_installer(aws_key_path, task):
     logger.addHandler(fh)
 
     output += 'connecting, '
-    ssh = paramiko.SSHClient()
-    ssh.set_log_channel(logname)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    while True:
-        try:
-            ssh.connect(instance.public_dns_name, username=task.image['Login'], key_filename='%s/%s.pem' % (aws_key_path, instance.key_name))
-            break
-        except:
-            output += 'sleep, '
-            time.sleep(60)
+    host = remote_host(aws_key_path, task, logname)
+    output += 'sleep, ' * host.connect()
+
+    out = StringIO.StringIO()
+    bundles = task.arg_list[0] + add_repos(host, task.arg_list[2], task.arg_list[3], out)
+    output += out.getvalue()
 
     output += 'installing\n'
-    has_error = False
-    for bundle in task.arg_list[0]:
-        name = bundle[0]
-        packages = bundle[1]
+    result, failed = install_bundles(host, bundles, task.arg_list[1], host_stream(task, 'group install'))
+    for line in result.stdout:
+        if any([item in line for item in NOTES]):
+            output += line
+    for name, lines in failed.items():
+        for line in lines:
+            output += '%s: %s' % (name, line)
+            emit('error', text='%s: %s' % (name, line))
+    if failed:
+        output += 'Unable to Continue!\n'
+        raise StepFailed(output)
 
-        stdin, stdout, stderr = ssh.exec_command('sudo apt-get -y install %s' % packages)
-        for line in stdout.readlines():
-            if any([item in line for item in ['Note, selecting', 'is already the newest version']]):
-                output += line
-        for line in stderr.readlines():
-            if line.startswith('E: '):
-                output += line
-                has_error = True
-        if has_error:
-            output += 'Unable to Continue!\n'
-            ssh.close()
-            return output
-        time.sleep(5)
+    for name, packages in bundles:
         if name == 'packages':
             output += 'Installed packages: %s\n' % packages
         else:
             output += 'Installed bundle: %s\n' % name
 
-    ssh.close()
     return output
 
 
 def py_installer(aws_key_path, task):
     output = 'Running Python Installer on %s\n' % task.instance_id
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
 
     output += 'logger, '
     logname = 'py_installer.%s' % instance.id
@@ -370,26 +487,28 @@ def py_installer(aws_key_path, task):
     logger.addHandler(fh)
 
     output += 'connecting'
-    ssh = paramiko.SSHClient()
-    ssh.set_log_channel(logname)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    while True:
-        try:
-            ssh.connect(instance.public_dns_name, username=task.image['Login'], key_filename='%s/%s.pem' % (aws_key_path, instance.key_name))
-            break
-        except:
-            output += ', sleep'
-            time.sleep(60)
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
     output += '\n'
 
     py_installer = task.arg_list[0]
     packages = task.arg_list[1]
-    stdin, stdout, stderr = ssh.exec_command('sudo %s %s' % (py_installer, packages))
-    for line in stdout.readlines():
+    if task.arg_list[2:] and task.arg_list[2] and py_installer.startswith('pip'):
+        output += 'building wheels\n'
+        pip = py_installer.split()[0]
+        result = host.run('sudo %s wheel -w %s %s' % (pip, WHEELHOUSE, packages), stream=host_stream(task, 'pip wheel'), keep=TAIL_LINES)
+        for line in result.stderr:
+            output += warning('wheel', line)
+        py_installer = '%s --find-links %s' % (py_installer, WHEELHOUSE)
+    result = host.run('sudo %s %s' % (py_installer, packages), stream=host_stream(task, 'python install'), keep=TAIL_LINES)
+    for line in result.stdout:
         if line.startswith('Installed') or line.startswith('Finished') or line.startswith('Successfully'):
             output += line
+    if result.status:
+        output += ''.join(result.stderr)
+        output += 'Unable to Continue!\n'
+        raise StepFailed(output)
 
-    ssh.close()
     return output
 
 
@@ -398,10 +517,7 @@ def script_runner(aws_key_path, task):
 
     user = task.arg_list[0]
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
     name_tag = instance.tags.get('Name')
 
     output += 'logger, '
@@ -412,17 +528,8 @@ def script_runner(aws_key_path, task):
     logger.addHandler(fh)
 
     output += 'connecting'
-    ssh = paramiko.SSHClient()
-    ssh.set_log_channel(logname)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-    while True:
-        try:
-            ssh.connect(instance.public_dns_name, username=task.image['Login'], key_filename='%s/%s.pem' % (aws_key_path, instance.key_name))
-            break
-        except:
-            output += ', sleep'
-            time.sleep(60)
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
     output += '\n'
 
     script = task.arg_list[1]
@@ -435,44 +542,32 @@ def script_runner(aws_key_path, task):
             format_args = task.build['ScriptFormatArgs'].split(',')
             format_args = [name_tag for arg in format_args if arg == '@name']
             contents = contents % tuple(format_args)
-        if user == task.image['Login']:
-            ssh.exec_command('cat << EOF > /home/%s/%s\n%s\nEOF' % (user, script_name, contents))
-        else:
-            ssh.exec_command('sudo su -c "cat << EOF > /home/%s/%s\n%s\nEOF" %s' % (user, script_name, contents, user))
-        time.sleep(5)
-        ssh.exec_command('sudo chown %(user)s:%(user)s /home/%(user)s/%(script)s' % {'user': user, 'script': script_name})
-        time.sleep(5)
-        ssh.exec_command('sudo chmod 744 /home/%(user)s/%(script)s' % {'user': user, 'script': script_name})
 
+    names = {'user': user, 'script': script_name, 'upload': '.clifford-%s' % script_name}
+    commands = []
+    if user == task.image['Login']:
+        host.put('/home/%(user)s/%(script)s' % names, contents, 0o744)
+    else:
+        host.put(names['upload'], contents, 0o744)
+        commands.append('sudo install -o %(user)s -g %(user)s -m 744 %(upload)s /home/%(user)s/%(script)s && rm -f %(upload)s' % names)
     if not copy_only:
-        channel = ssh.get_transport().open_session()
-        channel.settimeout(0.1)
-        channel.input_enabled = True
-        forward = paramiko.agent.AgentRequestHandler(channel)
-
-        channel.exec_command('sudo su -c "/home/%s/%s" %s' % (user, script_name, user))
+        commands.append('sudo su -c "/home/%(user)s/%(script)s" %(user)s' % names)
 
-        while True:
-            time.sleep(5)
-            if channel.exit_status_ready():
-                break
-        status = channel.recv_exit_status()
-        output += 'Script status: %s\n' % status
+    if commands:
+        result = host.run(' && '.join(commands), forward_agent=not copy_only,
+                          stream=host_stream(task, script_name), keep=TAIL_LINES)
+        output += 'Script status: %s\n' % result.status
+        if result.status:
+            output += ''.join(result.stderr)
+            raise StepFailed(output)
 
-        channel.close()
-        forward.close()
-
-    ssh.close()
     return output
 
 
 def static_host(aws_key_path, task):
     output = 'Running static_host on %s\n' % task.instance_id
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
     tag_name = task.arg_list[0]
 
     output += 'logger, '
@@ -483,37 +578,27 @@ def static_host(aws_key_path, task):
     logger.addHandler(fh)
 
     output += 'connecting'
-    ssh = paramiko.SSHClient()
-    ssh.set_log_channel(logname)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    while True:
-        try:
-            ssh.connect(instance.public_dns_name, username=task.image['Login'], key_filename='%s/%s.pem' % (aws_key_path, instance.key_name))
-            break
-        except:
-            output += ', sleep'
-            time.sleep(60)
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
 
     output += '\nUpdating /etc/hosts and setting Hostname.\n'
 
-    stdin, stdout, stderr = ssh.exec_command('sudo su -c "echo \'\n### CLIFFORD\n127.0.0.1\t%s\' >> /etc/hosts"' % tag_name)
-    for line in stderr.readlines():
-        output += 'ERROR (static_host hosts): %s\n' % line
+    result = host.run('sudo su -c "echo \'\n### CLIFFORD\n127.0.0.1\t%s\' >> /etc/hosts"' % tag_name)
+    for line in result.stderr:
+        output += warning('static_host hosts', line)
 
-    stdin, stdout, stderr = ssh.exec_command('sudo su -c "echo \'%s\' > /etc/hostname"' % tag_name)
-    for line in stderr.readlines():
-        output += 'ERROR (static_host hostname): %s\n' % line
+    result = host.run('sudo su -c "echo \'%s\' > /etc/hostname"' % tag_name)
+    for line in result.stderr:
+        output += warning('static_host hostname', line)
 
-    stdin, stdout, stderr = ssh.exec_command('sudo hostname -F /etc/hostname')
-    for line in stderr.readlines():
-        output += 'ERROR (static_host reload): %s\n' % line
+    result = host.run('sudo hostname -F /etc/hostname')
+    for line in result.stderr:
+        output += warning('static_host reload', line)
 
-    time.sleep(5)
     #output += 'Rebooting...\n'
     #instance.reboot()
     #time.sleep(60)
 
-    ssh.close()
     return output
 
 
@@ -521,10 +606,7 @@ def static_host(aws_key_path, task):
 def upgrade(aws_key_path, task):
     output = 'Running %s on %s\n' % (task.build['Upgrade'], task.instance_id)
 
-    output += 'instance, '
-    conn = boto.connect_ec2()
-    reservations = conn.get_all_instances(instance_ids=[task.instance_id])
-    instance = reservations[0].instances[0]
+    instance = task.instance
 
     output += 'logger, '
     logname = 'upgrade.%s' % instance.id
@@ -534,60 +616,48 @@ def upgrade(aws_key_path, task):
     logger.addHandler(fh)
 
     output += 'connecting'
-    ssh = paramiko.SSHClient()
-    ssh.set_log_channel(logname)
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    while True:
-        try:
-            ssh.connect(instance.public_dns_name, username=task.image['Login'], key_filename='%s/%s.pem' % (aws_key_path, instance.key_name))
-            break
-        except:
-            output += ', sleep'
-            time.sleep(60)
+    host = remote_host(aws_key_path, task, logname)
+    output += ', sleep' * host.connect()
 
     output += '\n'
     #output += 'hosts\n'
-    #stdin, stdout, stderr = ssh.exec_command('grep -Fq CLIFFORD /etc/hosts || sudo su -c "echo \'\n### CLIFFORD\n127.0.1.1\t%s\' >> /etc/hosts"' % instance.tags.get('Name'))
+    #result = host.run('grep -Fq CLIFFORD /etc/hosts || sudo su -c "echo \'\n### CLIFFORD\n127.0.1.1\t%s\' >> /etc/hosts"' % instance.tags.get('Name'))
 
     has_error = False
-    stdin, stdout, stderr = ssh.exec_command('sudo apt-get -y update')
-    for line in stderr.readlines():
+    result = host.run('sudo apt-get -y update', stream=host_stream(task, 'apt-get update'), keep=TAIL_LINES)
+    for line in result.stderr:
         if line.startswith('E: '):
             output += line
+            emit('error', text=line)
             has_error = True
-    if has_error:
+    if has_error or result.status:
         output += 'Unable to Continue!\n'
-        ssh.close()
-        return output
-    time.sleep(5)
+        raise StepFailed(output)
     output += 'UPDATED\n'
 
-    stdin, stdout, stderr = ssh.exec_command('sudo apt-get -s upgrade')
+    result = host.run('sudo apt-get -s upgrade')
     string_list = ['The following packages have been kept back:', 'The following packages will be upgraded:']
-    for line in stdout.readlines():
+    for line in result.stdout:
         if line.rstrip() in string_list or line.startswith('  '):
             output += line
-    time.sleep(5)
 
     if task.build['Upgrade'] in ['upgrade', 'dist-upgrade']:
-        stdin, stdout, stderr = ssh.exec_command('sudo su -c "env DEBIAN_FRONTEND=noninteractive apt-get -y -o DPkg::Options::=--force-confnew %s"' % task.build['Upgrade'])
-        for line in stderr.readlines():
+        result = host.run('sudo su -c "env DEBIAN_FRONTEND=noninteractive apt-get -y -o DPkg::Options::=--force-confnew %s"' % task.build['Upgrade'],
+                          stream=host_stream(task, 'apt-get %s' % task.build['Upgrade']), keep=TAIL_LINES)
+        for line in result.stderr:
             if line.startswith('E: '):
                 output += line
+                emit('error', text=line)
                 has_error = True
-        if has_error:
+        if has_error or result.status:
             output += 'Unable to Continue!\n'
-            ssh.close()
-            return output
-        time.sleep(5)
+            raise StepFailed(output)
         output += '%sD\n' % task.build['Upgrade'].upper()
 
-    ssh.close()
-
     if task.build['Upgrade'] == 'dist-upgrade':
-        time.sleep(5)
         output += 'Rebooting...\n'
-        instance.reboot()
+        ssh_sessions().close(instance.public_dns_name)
+        ec2_conn().reboot_instances([instance.id])
         time.sleep(60)
 
     return output
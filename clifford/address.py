@@ -1,8 +1,5 @@
-import os
 import time
 
-import paramiko
-
 from commands import BaseCommand
 from main import config
 
@@ -29,6 +26,7 @@ class Associate(BaseCommand):
         if self.sure_check():
             self.app.stdout.write('Attaching to Elastic IP...\n')
             address.associate(instance.id)
+            self.invalidate_instances([instance.id])
 
         if parsed_args.etc_hosts and 'Domain' in config:
             time.sleep(10)
@@ -37,13 +35,10 @@ class Associate(BaseCommand):
             if not login:
                 raise RuntimeError('No Login tag found!')
             self.app.stdout.write('Updating Hostname on %s...\n' % parsed_args.inst_name)
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=login, key_filename=os.path.join(config.aws_key_path, instance.key_name + ".pem"))
+            ssh = self.get_ssh(instance, login)
             stdin, stdout, stderr = ssh.exec_command('sudo su -c "echo %s > /etc/hostname && hostname -F /etc/hostname"' % parsed_args.inst_name)
             fqdn = '%s.%s' % (parsed_args.inst_name, config['Domain'])
             stdin, stdout, stderr = ssh.exec_command('sudo su -c "echo \'\n### CLIFFORD\n%s\t%s\t%s\' >> /etc/hosts"' % (address.public_ip, fqdn, parsed_args.inst_name))
-            ssh.close()
         else:
             raise RuntimeError('No Domain configured!')
 
@@ -67,6 +62,7 @@ class Disassociate(BaseCommand):
         if self.sure_check():
             self.app.stdout.write('Disassociating Elastic IP...\n')
             address.disassociate()
+            self.invalidate_instances([instance.id])
 
 
 class Allocate(BaseCommand):
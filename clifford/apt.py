@@ -0,0 +1,187 @@
+import re
+import threading
+from collections import OrderedDict
+
+from engine import CommandResult
+from runlog import TAIL_LINES
+
+
+NOTES = ['Note, selecting', 'is already the newest version', 'Already installed']
+WORD_REGEX = re.compile(r"[^\s'\"`,:;()]+")
+PACKAGE_REGEX = re.compile(r'^[a-z0-9][a-z0-9+.-]+$')
+
+_installed = {}
+_installed_lock = threading.Lock()
+
+
+def flatten_bundles(bundles):
+    """One deduplicated package list for a list of (bundle name, 'pkg pkg ...').
+
+    Returns (packages, owners) where owners maps each package to the names
+    of the bundles that asked for it, so errors can be traced back.
+    """
+    packages = []
+    owners = OrderedDict()
+    for name, bundle in bundles:
+        for package in bundle.split():
+            if package not in owners:
+                owners[package] = []
+                packages.append(package)
+            if name not in owners[package]:
+                owners[package].append(name)
+    return packages, owners
+
+
+def print_result(result, out):
+    for line in result.stdout:
+        out.write('OUT: %s' % line)
+    for line in result.stderr:
+        out.write('ERROR: %s' % line)
+
+
+def add_apt_repo(host, apt_repo, out):
+    "Add the source list and key of an (option, Apt: section) pair; returns the package it provides."
+    option, options = apt_repo
+    if 'keyserver' in options:
+        print_result(host.run('sudo apt-key adv --keyserver keyserver.ubuntu.com --recv %s 2>&1' % options['keyserver']), out)
+    elif 'publickey' in options:
+        key = options['publickey']
+        print_result(host.run('wget %s 2>&1' % key), out)
+        print_result(host.run('sudo apt-key add %s 2>&1' % key.split('/').pop()), out)
+    else:
+        raise RuntimeError('Invalid apt section!')
+
+    package = options['package']
+    host.run('sudo su -c "echo \'deb %s\' > /etc/apt/sources.list.d/%s.list"' % (options['deb'], package))
+    return package
+
+
+def add_ppa(host, ppa, out):
+    "Add the PPA of a (package name, ppa name) pair; returns the package."
+    package_name, ppa_name = ppa
+    print_result(host.run('sudo add-apt-repository -y ppa:%s 2>&1' % ppa_name), out)
+    return package_name
+
+
+def apt_update(host, out):
+    print_result(host.run('sudo apt-get -y update 2>&1'), out)
+    out.write('UPDATED\n')
+
+
+def add_repos(host, apt_repos, ppas, out):
+    "Add every apt repo and PPA, then update once; returns their packages as bundles."
+    bundles = []
+    for apt_repo in apt_repos:
+        bundles.append(('+' + apt_repo[0], add_apt_repo(host, apt_repo, out)))
+    for ppa in ppas:
+        bundles.append(('@' + ppa[0], add_ppa(host, ppa, out)))
+    if bundles:
+        apt_update(host, out)
+    return bundles
+
+
+def installed_packages(host):
+    "The packages installed on host, read with one dpkg-query and kept for the rest of the session."
+    with _installed_lock:
+        if host.host in _installed:
+            return _installed[host.host]
+    result = host.run("dpkg-query -W -f='${Package} ${Status}\\n'")
+    installed = set()
+    for line in result.stdout:
+        words = line.split()
+        if words[-3:] == ['install', 'ok', 'installed']:
+            installed.add(words[0])
+    with _installed_lock:
+        _installed[host.host] = installed
+    return installed
+
+
+def forget_installed(host):
+    with _installed_lock:
+        _installed.pop(host.host, None)
+
+
+def missing_packages(host, packages):
+    """The packages apt still has to install, in order.
+
+    Only plain package names are checked; versions, releases, architectures
+    and globs are always passed on to apt.
+    """
+    installed = installed_packages(host)
+    return [package for package in packages if package not in installed or not PACKAGE_REGEX.match(package)]
+
+
+def apt_install(host, packages, preseeds=(), stream=None):
+    """Preseed debconf in one call, then install packages in one apt transaction.
+
+    Packages the host already has are left out, and nothing runs at all
+    when every package is installed. The result holds the last TAIL_LINES
+    lines of output plus every E: line apt printed, for error attribution.
+    """
+    requested = packages.split()
+    missing = missing_packages(host, requested)
+    skipped = [package for package in requested if package not in missing]
+    notes = ['Already installed, skipping: %s\n' % ' '.join(skipped)] if skipped else []
+    if not missing:
+        return CommandResult(host.host, None, 0, notes, [])
+
+    errors = []
+
+    def watch(line, is_stderr):
+        if is_stderr and line.startswith('E: '):
+            errors.append(line)
+        if stream:
+            stream(line, is_stderr)
+
+    cmd = 'apt-get -y install %s' % ' '.join(missing)
+    if preseeds:
+        host.run('cat << EOF | sudo debconf-set-selections\n%s\nEOF' % '\n'.join(preseeds))
+        result = host.run('sudo su -c "env DEBIAN_FRONTEND=noninteractive %s"' % cmd, stream=watch, keep=TAIL_LINES)
+    else:
+        result = host.run('sudo %s' % cmd, stream=watch, keep=TAIL_LINES)
+
+    if result.status:
+        forget_installed(host)
+    else:
+        with _installed_lock:
+            _installed.get(host.host, set()).update(missing)
+    stderr = [line for line in result.stderr if not line.startswith('E: ')] + errors
+    return result._replace(stdout=notes + result.stdout, stderr=stderr)
+
+
+def install_bundles(host, bundles, preseeds=(), stream=None):
+    """Install every package of bundles in a single apt transaction.
+
+    Returns (result, failed): failed maps bundle names to the apt error
+    lines that belong to them and is empty when the install went through.
+    Errors that name a package go to the bundles owning it; anything else
+    is narrowed down by simulating each bundle's install on its own, and
+    what that still cannot place is reported under '(all)'.
+    """
+    packages, owners = flatten_bundles(bundles)
+    result = apt_install(host, ' '.join(packages), preseeds, stream)
+    errors = [line for line in result.stderr if line.startswith('E: ')]
+    failed = OrderedDict()
+    if not errors and not result.status:
+        return result, failed
+
+    unattributed = []
+    for line in errors:
+        names = [name for word in WORD_REGEX.findall(line[3:]) for name in owners.get(word, [])]
+        if not names:
+            unattributed.append(line)
+        for name in names:
+            failed.setdefault(name, []).append(line)
+
+    if unattributed or not failed:
+        for name, bundle in bundles:
+            check = host.run('apt-get -s -y install %s' % bundle)
+            for line in check.stderr:
+                if line.startswith('E: ') and line not in failed.get(name, []):
+                    failed.setdefault(name, []).append(line)
+    unplaced = [line for line in unattributed if not any(line in lines for lines in failed.values())]
+    if unplaced:
+        failed['(all)'] = unplaced
+    elif not failed:
+        failed['(all)'] = ['E: apt-get exited with status %s\n' % result.status]
+    return result, failed
@@ -1,14 +1,13 @@
 from collections import OrderedDict
-from multiprocessing import Pool, Queue
-import os
-import time
+from multiprocessing import Queue
 
-from activity import Task
-from activity import (add_user, elastic_ip, group_installer, launcher, py_installer,
-                      script_runner, static_host, upgrade, wait_for_ok)
+from activity import Task, launcher
 from commands import BaseCommand
 from main import config
 from mixins import LaunchOptionsMixin
+from pipeline import (Scheduler, build_steps, cache_for, cache_node, make_pool, parse_limits, release_when_ok,
+                      share_cache)
+from runlog import run_log
 
 
 class Build(BaseCommand, LaunchOptionsMixin):
@@ -17,9 +16,13 @@ class Build(BaseCommand, LaunchOptionsMixin):
     def get_parser(self, prog_name):
         parser = super(Build, self).get_parser(prog_name)
         parser.add_argument('-a', '--add', action='store_true')
+        parser.add_argument('-c', '--cache', action='store_true')
+        parser.add_argument('-l', '--limit', action='append', default=[], metavar='STEP=N')
         parser.add_argument('-n', '--num', type=int, default=1)
+        parser.add_argument('-p', '--processes', action='store_true')
         parser.add_argument('-r', '--remove', action='store_true')
         parser.add_argument('-u', '--update')
+        parser.add_argument('-w', '--workers', type=int)
         parser.add_argument('build_name')
         return parser
 
@@ -59,103 +62,40 @@ class Build(BaseCommand, LaunchOptionsMixin):
         build = config.builds[parsed_args.build_name]
         image = config.images[build['Image']]
 
+        self.app.stdout.write('Logging to %s\n' % run_log().path)
         q = Queue()
         launcher(tag_name, config.aws_key_path, config.script_path,
                  build_name=parsed_args.build_name, build=build, image=image,
                  num=parsed_args.num, q=q, out=self.app.stdout)
         lr = q.get()
+        self.invalidate_instances(lr.instance_ids)
+
+        instances = self.get_fresh_instances(lr.instance_ids)
+        pool = make_pool(len(lr.instance_ids), parsed_args.workers, parsed_args.processes)
+        scheduler = Scheduler(pool, config.aws_key_path, self.app.stdout,
+                              parse_limits(build.get('Limits', {}), parsed_args.limit))
+        server, address = cache_node(build, lr.instance_ids, instances, parsed_args.cache)
+        chain = []
+        for inst_id in lr.instance_ids:
+            ready = (inst_id, 'ready')
+            scheduler.gate(ready)
+            if inst_id not in instances:
+                scheduler.release(ready, False, '==>skipping: %s not found\n' % inst_id)
+            task = Task(build, image, inst_id, [], instances.get(inst_id))
+            steps = build_steps(build, image, tag_name, cache_for(inst_id, server, address))
+            scheduler.add_chain(inst_id, steps, task, after=[ready])
+            chain.append((inst_id, [step[0] for step in steps]))
+        if server:
+            share_cache(scheduler, server, chain)
 
         self.app.stdout.write('Allowing server to come up...\n')
-        wait_for_ok([inst_id for inst_id in lr.instance_ids])
-
-        # begin the mutliprocessing
-        pool = Pool(processes=len(lr.instance_ids))
-
-        if build.get('Upgrade', '') in ['upgrade', 'dist-upgrade']:
-            tasks = [Task(build, image, inst_id, []) for inst_id in lr.instance_ids]
-            self.run_activity(pool, upgrade, tasks)
-            self.app.stdout.write('Upgrade Finished\n')
-            if build.get('Upgrade') == 'dist-upgrade':
-                self.app.stdout.write('Rebooting after dist-upgrade...\n')
-                wait_for_ok([inst_id for inst_id in lr.instance_ids])
-
-        if build.get('Group', '') in config.groups:
-            bundles = []
-            self.get_bundles(build['Group'], bundles)
-            if bundles:
-                tasks = [Task(build, image, inst_id, [bundles]) for inst_id in lr.instance_ids]
-                self.run_activity(pool, group_installer, tasks)
-                self.app.stdout.write('Group Installer Finished\n')
-                time.sleep(10)
-
-        if build.get('PyGroup', '') in config.python_bundles:
-            python_packages = config.python_bundles[build['PyGroup']]
-            if python_packages:
-                tasks = [Task(build, image, inst_id, [config['PythonInstaller'], python_packages]) for inst_id in lr.instance_ids]
-                self.run_activity(pool, py_installer, tasks)
-                self.app.stdout.write('Python Installer Finished\n')
-                time.sleep(10)
-
-        if 'Script' in build:
-            tasks = [Task(build, image, inst_id, [image['Login'], os.path.join(config.script_path, build['Script']), False]) for inst_id in lr.instance_ids]
-            self.run_activity(pool, script_runner, tasks)
-            self.app.stdout.write('Script Runner Finished\n')
-            time.sleep(10)
-
-        if 'Adduser' in build:
-            tasks = [Task(build, image, inst_id, [config.pub_key_path]) for inst_id in lr.instance_ids]
-            self.run_activity(pool, add_user, tasks)
-            self.app.stdout.write('Adduser Finished\n')
-            time.sleep(10)
-
-            if 'Script' in build['Adduser']:
-                tasks = [Task(build, image, inst_id, [build['Adduser']['User'], os.path.join(config.script_path, build['Adduser']['Script']), True]) for inst_id in lr.instance_ids]
-                self.run_activity(pool, script_runner, tasks)
-                self.app.stdout.write('User Script Runner Finished\n')
-                time.sleep(10)
-
-        if 'ElasticIP' in build:
-            tasks = [Task(build, image, inst_id, []) for inst_id in lr.instance_ids]
-            self.run_activity(pool, elastic_ip, tasks)
-            self.app.stdout.write('ElasticIP Finished\n')
-            time.sleep(10)
-        elif 'StaticHost' not in build or build['StaticHost'] != 'skip':
-            tasks = [Task(build, image, inst_id, [tag_name]) for inst_id in lr.instance_ids]
-            self.run_activity(pool, static_host, tasks)
-            self.app.stdout.write('Static Host Finished\n')
-            time.sleep(10)
+        release_when_ok(scheduler, instances.keys(), self.app.stdout)
+        ok = scheduler.run()
 
         pool.close()
         pool.join()
-
-    def get_bundles(self, group, bundles):
-        for item in config.groups[group]:
-            if item['Type'] == 'bundle':
-                bundles.append((item['Value'], config.bundles[item['Value']]))
-            elif item['Type'] == 'group':
-                if item['Value'] in config.groups:
-                    self.get_bundles(item['Value'], bundles)
-            elif item['Type'] == 'packages':
-                bundles.append(('packages', item['Value']))
-
-    def run_activity(self, pool, func, tasks):
-        results = []
-        for task in tasks:
-            self.app.stdout.write('==>%s starting: %s\n' % (func.func_name, task.instance_id))
-            results.append(pool.apply_async(func, [config.aws_key_path, task]))
-
-        completed = []
-        while results:
-            time.sleep(20)
-            for result in results:
-                if result.ready():
-                    self.app.stdout.write('-------------------------\n')
-                    self.app.stdout.write(result.get())
-                    completed.append(result)
-            results = [result for result in results if result not in completed]
-            if not results:
-                break
-        self.app.stdout.write('-------------------------\n')
+        if not ok:
+            raise RuntimeError('Build finished with failed steps!')
 
     '''
     def wait_for_ok(self, instance_ids, time_to_wait=360):
@@ -1,8 +1,15 @@
 import logging
+import StringIO
+from multiprocessing.pool import ThreadPool
 
 from cliff.command import Command
 
+from engine import remote_engine
+from main import config
 from mixins import PreseedMixin, InstanceMixin
+from pipeline import completed
+from query import Selector
+from ssh import ssh_sessions
 
 
 def enum(**enums):
@@ -19,12 +26,7 @@ class BaseCommand(Command, InstanceMixin):
     def is_ok(self, name):
         if not name:
             return False
-        reservations = self.app.ec2_conn.get_all_instances()
-        for reservation in reservations:
-            for instance in reservation.instances:
-                if name == instance.tags.get('Name', ''):
-                    return False
-        return True
+        return not self.is_name_taken(name)
 
     def question_maker(self, question, item_type, dict_list, start_at=1, multiple_answers=False):
         self.app.stdout.write(question + '\n')
@@ -62,10 +64,20 @@ class BaseCommand(Command, InstanceMixin):
             return False
         return True
 
-    def printOutError(self, out, error):
-        for line in out.readlines():
+    def get_ssh(self, instance, username=None, with_key=True):
+        username = username or self.get_user(instance)
+        key_filename = '%s/%s.pem' % (config.aws_key_path, instance.key_name) if with_key else None
+        return ssh_sessions().get(instance.public_dns_name, username, key_filename)
+
+    def get_remote(self, instance, username=None, with_key=True, timeout=None):
+        username = username or self.get_user(instance)
+        key_filename = '%s/%s.pem' % (config.aws_key_path, instance.key_name) if with_key else None
+        return remote_engine().host(instance.public_dns_name, username, key_filename, timeout=timeout)
+
+    def printOutError(self, result):
+        for line in result.stdout:
             self.app.stdout.write('OUT: %s' % line)
-        for line in error.readlines():
+        for line in result.stderr:
             self.app.stdout.write('ERROR: %s' % line)
 
 
@@ -83,3 +95,84 @@ class RemoteUserCommand(BaseCommand):
         parser = super(RemoteUserCommand, self).get_parser(prog_name)
         parser.add_argument('user')
         return parser
+
+
+class FleetCommand(BaseCommand):
+    "A remote command run on one named instance or on every running instance a selector matches."
+
+    def get_parser(self, prog_name):
+        parser = super(FleetCommand, self).get_parser(prog_name)
+        parser.add_argument('--id', dest='arg_is_id', action='store_true')
+        parser.add_argument('--project')
+        parser.add_argument('--build')
+        parser.add_argument('--prefix')
+        parser.add_argument('-w', '--workers', type=int)
+        parser.add_argument('name', nargs='?')
+        return parser
+
+    def get_targets(self, parsed_args):
+        if parsed_args.project or parsed_args.build or parsed_args.prefix:
+            selector = Selector(names=[parsed_args.name] if parsed_args.name else None,
+                                prefixes=[parsed_args.prefix] if parsed_args.prefix else None,
+                                project=parsed_args.project, build=parsed_args.build, states=['running'])
+            instances = self.instance_index.select(selector)
+            if not instances:
+                raise RuntimeError('No instances found!')
+            return instances
+        if not parsed_args.name:
+            raise RuntimeError('Name an instance or select some with --project, --build or --prefix!')
+        return [self.get_instance(parsed_args.name, parsed_args.arg_is_id)]
+
+    def sure_targets(self, instances):
+        if len(instances) > 1:
+            self.app.stdout.write('%d instances: %s\n' % (len(instances), ', '.join(instance.name for instance in instances)))
+        return self.sure_check()
+
+    def each(self, instances, func, workers=None):
+        """Run func(instance) on every instance, at most `workers` (config Workers) at a time.
+
+        Yields (index, ok, result or traceback, started, finished) as each
+        host finishes; Ctrl-C cancels the remote work still in flight.
+        """
+        remote_engine(workers)
+        pool = ThreadPool(processes=min(len(instances), workers or config.workers))
+        try:
+            for outcome in completed(pool, [(func, [instance], {}) for instance in instances]):
+                yield outcome
+        except KeyboardInterrupt:
+            remote_engine().cancel()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+    def fan_out(self, instances, func, workers=None):
+        """Run func(instance, out) on every instance through each().
+
+        One instance writes straight to stdout and its errors propagate as
+        before. Several get one block of output each as they finish, then a
+        per-host summary; the command fails if any host did.
+        """
+        if len(instances) == 1:
+            func(instances[0], self.app.stdout)
+            return
+
+        buffers = dict((instance.id, StringIO.StringIO()) for instance in instances)
+        rows = [None] * len(instances)
+        for index, ok, result, started, finished in self.each(instances, lambda instance: func(instance, buffers[instance.id]), workers):
+            note = '' if ok else result.strip().splitlines()[-1]
+            rows[index] = (ok, finished - started, note)
+            self.app.stdout.write('-------------------------\n')
+            self.app.stdout.write('%s (%s)\n' % (instances[index].name, instances[index].id))
+            self.app.stdout.write(buffers[instances[index].id].getvalue())
+            if note:
+                self.app.stdout.write('%s\n' % note)
+
+        self.app.stdout.write('-------------------------\n')
+        width = max(len(instance.name) for instance in instances)
+        for instance, (ok, elapsed, note) in zip(instances, rows):
+            line = '%-*s  %-10s  %-6s  %6.1fs  %s' % (width, instance.name, instance.id, 'ok' if ok else 'failed', elapsed, note)
+            self.app.stdout.write(line.rstrip() + '\n')
+        failed = len([row for row in rows if not row[0]])
+        if failed:
+            raise RuntimeError('%d of %d hosts failed!' % (failed, len(instances)))
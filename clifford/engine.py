@@ -0,0 +1,267 @@
+import os
+import select
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
+
+from main import config
+from ssh import ssh_sessions
+
+
+BUFFER_SIZE = 32768
+CONNECT_WAIT = 600
+
+CommandResult = namedtuple('CommandResult', ['host', 'command', 'status', 'stdout', 'stderr'])
+
+
+class Cancelled(RuntimeError):
+    pass
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+def emit_lines(stream, data, is_stderr):
+    "Pass each complete line in data to stream; returns the unfinished tail."
+    lines = data.splitlines(True)
+    if lines and not lines[-1].endswith('\n'):
+        tail = lines.pop()
+        if len(tail) > BUFFER_SIZE:
+            lines.append(tail)
+            tail = ''
+    else:
+        tail = ''
+    for line in lines:
+        stream(line, is_stderr)
+    return tail
+
+
+class Slots(object):
+    "A counting semaphore whose waits give up on cancellation or a deadline; size 0 means unlimited."
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, engine, deadline):
+        with self.cond:
+            while self.size and self.used >= self.size:
+                engine.check(deadline)
+                self.cond.wait(0.5)
+            self.used += 1
+
+    def release(self):
+        with self.cond:
+            self.used -= 1
+            self.cond.notify()
+
+    def resize(self, size):
+        with self.cond:
+            self.size = size
+            self.cond.notify_all()
+
+
+class RemoteEngine(object):
+    """Run remote commands for many hosts from one process.
+
+    Every command holds a global slot and a slot on its host while it runs,
+    so `limit` caps the sessions in flight and `per_host` keeps commands to
+    one host from piling up. Waiting is select-driven, not sleep-polled.
+    cancel() closes every open channel and makes pending commands give up.
+    """
+
+    def __init__(self, limit=0, per_host=1):
+        self.slots = Slots(limit)
+        self.per_host = per_host
+        self.host_slots = {}
+        self.channels = set()
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+    def host(self, host, username, key_filename=None, timeout=None, log_channel=None):
+        "A handle on host whose commands all have to finish within `timeout` seconds."
+        deadline = time.time() + timeout if timeout else None
+        return RemoteHost(self, host, username, key_filename, deadline, log_channel)
+
+    def slots_for(self, host):
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = Slots(self.per_host)
+            return self.host_slots[host]
+
+    def check(self, deadline=None):
+        if self.cancelled.is_set():
+            raise Cancelled('Cancelled')
+        if deadline and time.time() >= deadline:
+            raise DeadlineExceeded('Deadline exceeded')
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            channels = list(self.channels)
+        for channel in channels:
+            channel.close()
+
+    def execute(self, client, host, command, deadline=None, forward_agent=False, stream=None, keep=None):
+        """Run command on a connected client and collect its output.
+
+        stream, if given, is called with (line, is_stderr) for every line as
+        it arrives, so callers can show output live. keep, if given, is how
+        many of the last lines of each of stdout and stderr the result holds,
+        so a command that prints without end does not fill memory.
+        """
+        channel = client.get_transport().open_session()
+        forward = None
+        if forward_agent:
+            import paramiko.agent
+            forward = paramiko.agent.AgentRequestHandler(channel)
+        with self.lock:
+            self.channels.add(channel)
+
+        kept = (deque(maxlen=keep), deque(maxlen=keep))
+        partial = ['', '']
+
+        def take(line, is_stderr):
+            kept[is_stderr].append(line)
+            if stream:
+                stream(line, is_stderr)
+
+        try:
+            channel.exec_command(command)
+            while True:
+                received = False
+                while channel.recv_ready():
+                    partial[0] = emit_lines(take, partial[0] + channel.recv(BUFFER_SIZE), False)
+                    received = True
+                while channel.recv_stderr_ready():
+                    partial[1] = emit_lines(take, partial[1] + channel.recv_stderr(BUFFER_SIZE), True)
+                    received = True
+                if not received and channel.exit_status_ready():
+                    break
+                self.check(deadline)
+                if not received:
+                    select.select([channel], [], [], 0.2)
+            status = channel.recv_exit_status()
+        finally:
+            with self.lock:
+                self.channels.discard(channel)
+            channel.close()
+            if forward is not None:
+                forward.close()
+
+        for is_stderr, rest in enumerate(partial):
+            if rest:
+                kept[is_stderr].append(rest)
+                if stream:
+                    stream(rest + '\n', bool(is_stderr))
+        return CommandResult(host, command, status, list(kept[0]), list(kept[1]))
+
+
+class RemoteHost(object):
+    "One host's commands, run under the engine's limits until the host's deadline."
+
+    def __init__(self, engine, host, username, key_filename, deadline, log_channel):
+        self.engine = engine
+        self.host = host
+        self.username = username
+        self.key_filename = key_filename
+        self.deadline = deadline
+        self.log_channel = log_channel
+
+    def client(self):
+        return ssh_sessions().get(self.host, self.username, self.key_filename, log_channel=self.log_channel)
+
+    def connect(self, longest=60, wait=CONNECT_WAIT):
+        """Wait for the host to take an SSH connection; returns how many attempts failed.
+
+        Gives up after `wait` seconds, or sooner at the host's deadline. A
+        key that cannot be loaded or a login the host rejects fails at once,
+        as retrying cannot help.
+        """
+        import paramiko
+
+        deadline = time.time() + wait
+        if self.deadline:
+            deadline = min(deadline, self.deadline)
+        failures = 0
+        delay = 5
+        while True:
+            self.engine.check(deadline)
+            try:
+                self.client()
+                return failures
+            except (paramiko.AuthenticationException, RuntimeError):
+                raise
+            except Exception:
+                failures += 1
+            delay = min(delay, max(deadline - time.time(), 0))
+            self.engine.cancelled.wait(delay)
+            delay = min(delay * 2, longest)
+
+    @contextmanager
+    def held(self):
+        "Hold this host's slot and a global one."
+        host_slots = self.engine.slots_for(self.host)
+        host_slots.acquire(self.engine, self.deadline)
+        try:
+            self.engine.slots.acquire(self.engine, self.deadline)
+            try:
+                yield
+            finally:
+                self.engine.slots.release()
+        finally:
+            host_slots.release()
+
+    def run(self, command, forward_agent=False, stream=None, keep=None):
+        "Run command and wait for it to exit; returns a CommandResult with stdout/stderr as lines."
+        client = self.client()
+        with self.held():
+            return self.engine.execute(client, self.host, command, self.deadline, forward_agent, stream, keep)
+
+    @contextmanager
+    def sftp(self):
+        "An SFTP session on the host's pooled connection, held under the engine's limits."
+        client = self.client()
+        with self.held():
+            self.engine.check(self.deadline)
+            sftp = client.open_sftp()
+            try:
+                yield sftp
+            finally:
+                sftp.close()
+
+    def put(self, path, contents, mode=None):
+        "Write contents to path over SFTP, setting mode on the open file instead of in another command."
+        with self.sftp() as sftp:
+            f = sftp.open(path, 'wb')
+            try:
+                f.set_pipelined(True)
+                if mode is not None:
+                    f.chmod(mode)
+                f.write(contents)
+            finally:
+                f.close()
+
+
+_engine = (None, None)
+_engine_lock = threading.Lock()
+
+
+def remote_engine(limit=None):
+    """The remote engine for this process, shared by every thread a worker pool runs.
+
+    Its sessions are capped at `limit`, config Workers by default; a command
+    with its own -w/--workers passes it in before starting its pool.
+    """
+    global _engine
+    with _engine_lock:
+        pid, engine = _engine
+        if engine is None or pid != os.getpid():
+            engine = RemoteEngine(limit or config.workers)
+            _engine = (os.getpid(), engine)
+        elif limit:
+            engine.slots.resize(limit)
+        return engine
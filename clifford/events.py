@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from runlog import run_log
+
+
+_current = threading.local()
+
+
+@contextmanager
+def reporting(queue, host, step):
+    "Send the events of the step this thread runs, for host, to queue."
+    previous = getattr(_current, 'report', None)
+    _current.report = (queue, host, step)
+    try:
+        yield
+    finally:
+        _current.report = previous
+
+
+def emit(event, **fields):
+    """Queue an event about the current step for the coordinator.
+
+    Events are small dicts: event, host, step, time and whatever fields the
+    caller adds. Returns False when the thread is not running a step.
+    """
+    report = getattr(_current, 'report', None)
+    if report is None:
+        return False
+    queue, host, step = report
+    fields.update(event=event, host=host, step=step, time=time.time())
+    queue.put(fields)
+    return True
+
+
+def line_stream(host, title):
+    "A RemoteHost.run stream: line events inside a step, straight into the run log outside one."
+    if getattr(_current, 'report', None) is None:
+        return run_log().stream(host, title)
+    emit('command', text=title)
+    return lambda line, is_stderr: emit('line', text=line, stream='stderr' if is_stderr else 'stdout')
+
+
+class EventLog(object):
+    """Render worker events live and keep them in the run's events.jsonl.
+
+    Lines go to the run log, so to the console and the host's log file;
+    every event is also written as one JSON object per line.
+    """
+
+    def __init__(self, queue, log=None):
+        self.queue = queue
+        self.log = log or run_log()
+        self.thread = None
+
+    def start(self):
+        if not os.path.isdir(self.log.path):
+            os.makedirs(self.log.path)
+        self.file = open(os.path.join(self.log.path, 'events.jsonl'), 'a')
+        self.thread = threading.Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+    def loop(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            self.handle(event)
+
+    def handle(self, event):
+        self.file.write(json.dumps(event, sort_keys=True) + '\n')
+        self.file.flush()
+        kind = event['event']
+        if kind == 'line':
+            self.log.write(event['host'], event['text'], event['stream'] == 'stderr')
+        elif kind in ['started', 'command']:
+            self.log.write(event['host'], '==> %s\n' % event.get('text', event['step']), echo=False)
+        elif kind in ['warning', 'error']:
+            self.log.write(event['host'], '%s: %s' % (kind.upper(), event['text']), True)
+        elif kind == 'finished':
+            self.log.write(event['host'], '<== %s %s in %.1fs\n' % (event['step'], 'finished' if event['ok'] else 'failed',
+                                                                 event['duration']), echo=False)
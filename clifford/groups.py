@@ -0,0 +1,101 @@
+import hashlib
+import json
+from collections import OrderedDict, namedtuple
+
+from apt import flatten_bundles
+
+
+CompiledGroup = namedtuple('CompiledGroup', ['bundles', 'packages', 'apt_repos', 'ppas', 'missing'])
+
+PREFIXES = OrderedDict([('&', 'group'), ('+', 'apt'), ('@', 'ppa'), ('$', 'packages')])
+
+
+def group_items(value):
+    """A group's items as (type, value) pairs.
+
+    Groups are either lists of {'Type', 'Value'} dicts or the older space
+    separated string where &group, +apt, @ppa and $package are prefixed and
+    anything else names a bundle.
+    """
+    if isinstance(value, basestring):
+        items = []
+        for word in value.split():
+            if word[0] in PREFIXES:
+                items.append((PREFIXES[word[0]], word[1:]))
+            else:
+                items.append(('bundle', word))
+        return items
+    return [(item['Type'], item['Value']) for item in value]
+
+
+def describe_items(value):
+    "A group's items in the short prefixed form, e.g. 'dev &base $curl'."
+    words = []
+    prefixes = dict((item_type, prefix) for prefix, item_type in PREFIXES.items())
+    for item_type, item_value in group_items(value):
+        if item_type == 'packages':
+            words.extend('$' + package for package in item_value.split())
+        else:
+            words.append(prefixes.get(item_type, '') + item_value)
+    return ' '.join(words)
+
+
+def compile_groups(groups, bundles):
+    """Resolve every group into a CompiledGroup, with included groups flattened in.
+
+    Each group is resolved once however many groups include it, and a group
+    that includes itself, directly or not, is rejected. The result is cached
+    until the groups or bundles change.
+    """
+    global _compiled
+    key = hashlib.sha1(json.dumps([groups, bundles], sort_keys=True)).hexdigest()
+    if _compiled[0] == key:
+        return _compiled[1]
+
+    compiled = OrderedDict()
+
+    def resolve(name, path):
+        if name in compiled:
+            return compiled[name]
+        if name in path:
+            raise RuntimeError('Group loop: %s' % ' -> '.join(path[path.index(name):] + [name]))
+
+        entries, apt_repos, ppas, missing = [], [], [], []
+
+        def add(items, entry):
+            if entry not in items:
+                items.append(entry)
+
+        for item_type, value in group_items(groups[name]):
+            if item_type == 'bundle':
+                if value in bundles:
+                    add(entries, (value, bundles[value]))
+                else:
+                    add(missing, value)
+            elif item_type == 'packages':
+                add(entries, ('packages', value))
+            elif item_type == 'apt':
+                add(apt_repos, value)
+            elif item_type == 'ppa':
+                add(ppas, value)
+            elif item_type == 'group':
+                if value not in groups:
+                    add(missing, '&' + value)
+                    continue
+                included = resolve(value, path + [name])
+                for items, more in zip([entries, apt_repos, ppas, missing], included[:1] + included[2:]):
+                    for entry in more:
+                        add(items, entry)
+            else:
+                raise RuntimeError('Group %s has an item of unknown type %s!' % (name, item_type))
+
+        compiled[name] = CompiledGroup(entries, flatten_bundles(entries)[0], apt_repos, ppas, missing)
+        return compiled[name]
+
+    for name in groups:
+        resolve(name, [])
+    _compiled = (key, compiled)
+    return compiled
+
+
+_compiled = (None, None)
@@ -0,0 +1,262 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict, defaultdict
+
+from query import Selector, base_name, describe
+
+
+SCHEMA_VERSION = 3
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS instances (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    base_name TEXT NOT NULL DEFAULT '',
+    project TEXT NOT NULL DEFAULT '',
+    build TEXT NOT NULL DEFAULT '',
+    state TEXT NOT NULL DEFAULT '',
+    public_dns_name TEXT NOT NULL DEFAULT '',
+    private_ip_address TEXT NOT NULL DEFAULT '',
+    key_name TEXT NOT NULL DEFAULT '',
+    image_id TEXT NOT NULL DEFAULT '',
+    tags TEXT NOT NULL DEFAULT '{}',
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_name ON instances (name);
+CREATE INDEX IF NOT EXISTS instances_base_name ON instances (base_name);
+CREATE INDEX IF NOT EXISTS instances_project ON instances (project);
+CREATE INDEX IF NOT EXISTS instances_build ON instances (build);
+CREATE TABLE IF NOT EXISTS dirty (id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+class InstanceRecord(object):
+    "The handful of instance fields clifford commands actually use."
+
+    __slots__ = ('id', 'name', 'state', 'public_dns_name', 'private_ip_address', 'key_name', 'image_id', 'tags')
+
+    def __init__(self, id, name, state, public_dns_name, private_ip_address, key_name, image_id, tags):
+        self.id = id
+        self.name = name
+        self.state = state
+        self.public_dns_name = public_dns_name
+        self.private_ip_address = private_ip_address
+        self.key_name = key_name
+        self.image_id = image_id
+        self.tags = tags
+
+    @classmethod
+    def from_instance(cls, instance):
+        return cls(instance.id,
+                   instance.tags.get('Name', ''),
+                   instance.state,
+                   instance.public_dns_name or '',
+                   instance.private_ip_address or '',
+                   instance.key_name or '',
+                   instance.image_id or '',
+                   dict(instance.tags))
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'],
+                   row['name'],
+                   row['state'],
+                   row['public_dns_name'],
+                   row['private_ip_address'],
+                   row['key_name'],
+                   row['image_id'],
+                   json.loads(row['tags']))
+
+    def __getstate__(self):
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def __setstate__(self, state):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def __repr__(self):
+        return '<InstanceRecord %s %s>' % (self.id, self.name)
+
+
+class Inventory(object):
+    "Local sqlite cache of the account's instances, indexed by id and tags."
+
+    def __init__(self, conn, path, ttl):
+        self.conn = conn
+        self.path = path
+        self.ttl = ttl
+        self._db = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.row_factory = sqlite3.Row
+            if self._db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                self._db.executescript('DROP TABLE IF EXISTS instances; '
+                                       'DROP TABLE IF EXISTS dirty; '
+                                       'DROP TABLE IF EXISTS meta; '
+                                       'PRAGMA user_version = %d;' % SCHEMA_VERSION)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def is_stale(self):
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'refreshed'").fetchone()
+        if not row:
+            return True
+        return time.time() - float(row['value']) >= self.ttl
+
+    def invalidate(self, instance_ids=None):
+        "Mark instances (or the whole inventory) as needing a refresh."
+        if not self.enabled:
+            return
+        with self.db:
+            if instance_ids is None:
+                self.db.execute("DELETE FROM meta WHERE key = 'refreshed'")
+            else:
+                self.db.executemany('INSERT OR IGNORE INTO dirty (id) VALUES (?)',
+                                    [(inst_id,) for inst_id in instance_ids])
+
+    def refresh(self, force=False):
+        if force or self.is_stale():
+            now = time.time()
+            records = [InstanceRecord.from_instance(inst) for inst in describe(self.conn, Selector(states=None))]
+            with self.db:
+                self.upsert(records, now)
+                self.db.execute('DELETE FROM instances WHERE updated < ?', (now,))
+                self.db.execute('DELETE FROM dirty')
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('refreshed', ?)", (repr(now),))
+            return
+
+        dirty = [row['id'] for row in self.db.execute('SELECT id FROM dirty')]
+        if not dirty:
+            return
+        records = [InstanceRecord.from_instance(inst) for inst in describe(self.conn, Selector(ids=dirty, states=None))]
+        with self.db:
+            self.upsert(records, time.time())
+            found = set(record.id for record in records)
+            self.db.executemany('DELETE FROM instances WHERE id = ?',
+                                [(inst_id,) for inst_id in dirty if inst_id not in found])
+            self.db.executemany('DELETE FROM dirty WHERE id = ?', [(inst_id,) for inst_id in dirty])
+
+    def upsert(self, records, now):
+        rows = []
+        for record in records:
+            rows.append((record.id,
+                         record.name,
+                         base_name(record.name),
+                         record.tags.get('Project', ''),
+                         record.tags.get('Build', ''),
+                         record.state,
+                         record.public_dns_name,
+                         record.private_ip_address,
+                         record.key_name,
+                         record.image_id,
+                         json.dumps(record.tags),
+                         now))
+        self.db.executemany('INSERT OR REPLACE INTO instances '
+                            '(id, name, base_name, project, build, state, public_dns_name, private_ip_address, key_name, image_id, tags, updated) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def records(self, selector):
+        "Return a record for every instance the selector matches."
+        if not self.enabled:
+            return [InstanceRecord.from_instance(inst) for inst in describe(self.conn, selector)]
+
+        self.refresh()
+        where, params = self.where(selector)
+        records = [InstanceRecord.from_row(row) for row in self.db.execute('SELECT * FROM instances' + where, params)]
+        return [record for record in records if selector.match(record.id, record.state, record.tags)]
+
+    def where(self, selector):
+        "The indexed part of a selector as a WHERE clause and its parameters; prefixes and states are matched in Python."
+        clauses, params = [], []
+
+        def any_of(column, values):
+            clauses.append('%s IN (%s)' % (column, ', '.join('?' * len(values))))
+            params.extend(values)
+
+        if selector.ids:
+            any_of('id', selector.ids)
+        if selector.project:
+            clauses.append('project = ?')
+            params.append(selector.project)
+        if selector.build:
+            clauses.append('build = ?')
+            params.append(selector.build)
+        if (selector.names or selector.base_names) and not selector.prefixes:
+            names = selector.names + selector.base_names
+            clause = 'name IN (%s)' % ', '.join('?' * len(names))
+            params.extend(names)
+            if selector.base_names:
+                clause = '(%s OR base_name IN (%s))' % (clause, ', '.join('?' * len(selector.base_names)))
+                params.extend(selector.base_names)
+            clauses.append(clause)
+        if not clauses:
+            return '', params
+        return ' WHERE ' + ' AND '.join(clauses), params
+
+
+class InstanceIndex(object):
+    "Per-invocation view of the instances, built from at most one describe."
+
+    def __init__(self, inventory):
+        self.inventory = inventory
+        self.complete = False
+        self.loaded = []
+        self.by_id = OrderedDict()
+        self.by_name = defaultdict(list)
+        self.by_base_name = defaultdict(list)
+        self.by_project = defaultdict(list)
+        self.by_build = defaultdict(list)
+
+    def add(self, record):
+        if record.id in self.by_id:
+            return
+        self.by_id[record.id] = record
+        self.by_name[record.name].append(record)
+        self.by_base_name[base_name(record.name)].append(record)
+        self.by_project[record.tags.get('Project', '')].append(record)
+        self.by_build[record.tags.get('Build', '')].append(record)
+
+    def load(self, selector):
+        if self.complete or selector.filters() in self.loaded:
+            return
+        if self.inventory.enabled:
+            records = self.inventory.records(Selector(states=None))
+            self.complete = True
+        else:
+            records = self.inventory.records(selector)
+            self.loaded.append(selector.filters())
+        for record in records:
+            self.add(record)
+
+    def candidates(self, selector):
+        if selector.ids:
+            return [self.by_id[inst_id] for inst_id in selector.ids if inst_id in self.by_id]
+        if selector.project:
+            return self.by_project.get(selector.project, [])
+        if selector.build:
+            return self.by_build.get(selector.build, [])
+        if selector.names or selector.base_names:
+            records = []
+            for name in selector.names + selector.base_names:
+                records.extend(self.by_name.get(name, []))
+            for name in selector.base_names:
+                records.extend(self.by_base_name.get(name, []))
+            return records
+        return self.by_id.values()
+
+    def select(self, selector):
+        self.load(selector)
+        selected = OrderedDict()
+        for record in self.candidates(selector):
+            if selector.match(record.id, record.state, record.tags):
+                selected[record.id] = record
+        return selected.values()
@@ -1,3 +1,5 @@
+from multiprocessing import Queue
+
 from activity import launcher
 from commands import BaseCommand
 from main import config
@@ -48,5 +50,7 @@ class Launch(BaseCommand, LaunchOptionsMixin):
 
         image = config.images[image_key]
 
+        q = Queue()
         launcher(parsed_args.tag_name, config.aws_key_path, config.script_path,
-                 build=build, image=image, num=num, out=self.app.stdout)
+                 build=build, image=image, num=num, q=q, out=self.app.stdout)
+        self.invalidate_instances(q.get().instance_ids)
@@ -1,13 +1,28 @@
 import logging
 import os
+import struct
+import sys
 
 from cliff.lister import Lister
 
+from groups import describe_items
 from main import config
 from mixins import InstanceMixin
 
 
-ROWS, COLUMNS = [int(item) for item in os.popen('stty size', 'r').read().split()]
+def terminal_width(default=80):
+    try:
+        import fcntl
+        import termios
+        rows, columns = struct.unpack('hh', fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234'))
+        if columns > 0:
+            return columns
+    except (ImportError, IOError, ValueError, AttributeError):
+        pass
+    try:
+        return int(os.environ.get('COLUMNS', default))
+    except ValueError:
+        return default
 
 
 class Addresses(Lister):
@@ -103,7 +118,7 @@ class Bundles(Lister):
             raise RuntimeError('No %s found!' % bundle_type)
 
         max_name_len = max(4, max([len(bundle) for bundle in bundles.keys()]))
-        max_bundles_len = COLUMNS - max_name_len - 7
+        max_bundles_len = terminal_width() - max_name_len - 7
 
         bundle_tuples = []
         for bundle in bundles.keys():
@@ -128,20 +143,11 @@ class Groups(Lister):
             raise RuntimeError('No Groups found!')
 
         max_name_len = max(4, max([len(group) for group in groups.keys()]))
-        max_groups_len = COLUMNS - max_name_len - 7
+        max_groups_len = terminal_width() - max_name_len - 7
 
         group_tuples = []
         for group in groups.keys():
-            items = ''
-            for item in groups[group]:
-                if item['Type'] == 'bundle':
-                    items += item['Value'] + ' '
-                elif item['Type'] == 'group':
-                    items += '&' + item['Value'] + ' '
-                elif item['Type'] == 'packages':
-                    items += '$' + ' $'.join(item['Value'].split(' ')) + ' '
-            if items:
-                items = items[:-1]
+            items = describe_items(groups[group])
 
             if len(items) > max_groups_len:
                 group_tuples.append((group, items[:max_groups_len - 3] + '...'))
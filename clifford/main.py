@@ -4,7 +4,6 @@ import os
 import sys
 from collections import OrderedDict
 
-import boto
 from cliff.app import App
 from cliff.commandmanager import CommandManager
 
@@ -22,14 +21,31 @@ class CliffordApp(App):
             version='0.1',
             command_manager=CommandManager('clifford', convert_underscores=False),
             )
-        self.ec2_conn = boto.connect_ec2()
-        self.s3_conn = boto.connect_s3()
+        self._ec2_conn = None
+        self._s3_conn = None
+        self.inventory = None
+        self.instance_index = None
+
+    @property
+    def ec2_conn(self):
+        if self._ec2_conn is None:
+            import boto
+            self._ec2_conn = boto.connect_ec2()
+        return self._ec2_conn
+
+    @property
+    def s3_conn(self):
+        if self._s3_conn is None:
+            import boto
+            self._s3_conn = boto.connect_s3()
+        return self._s3_conn
 
     def initialize_app(self, argv):
         self.log.debug('initialize_app')
 
     def prepare_to_run_command(self, cmd):
         self.log.debug('prepare_to_run_command %s', cmd.__class__.__name__)
+        self.instance_index = None
 
     def clean_up(self, cmd, result, err):
         self.log.debug('clean_up %s', cmd.__class__.__name__)
@@ -53,6 +69,28 @@ class OrderedConfig(OrderedDict):
     def script_path(self):
         return self.get_path('ScriptPath')
 
+    @property
+    def inventory_path(self):
+        return os.path.join(os.path.dirname(self.config_file), 'inventory.db')
+
+    @property
+    def log_path(self):
+        if 'LogPath' in self:
+            return self.get_path('LogPath')
+        return os.path.join(os.path.dirname(self.config_file), 'logs')
+
+    @property
+    def inventory_ttl(self):
+        return int(self.get('InventoryTTL', 300))
+
+    @property
+    def workers(self):
+        return int(self.get('Workers', 20))
+
+    @property
+    def worker_processes(self):
+        return bool(self.get('WorkerProcesses', False))
+
     @property
     def images(self):
         if 'Images' not in self:
@@ -1,7 +1,8 @@
 import glob
-import re
 
+from inventory import InstanceIndex, InstanceRecord, Inventory
 from main import config
+from query import Selector, describe
 
 
 class LaunchOptionsMixin(object):
@@ -125,108 +126,93 @@ class LaunchOptionsMixin(object):
         return user_data
 
 
+def get_preseeds(packages):
+    "Every debconf preseed configured for the packages, once each, for a single debconf-set-selections call."
+    preseeds = []
+    for package in packages:
+        full_name = 'debconf:%s' % package
+        if full_name not in config:
+            continue
+        options = config[full_name]
+        for option in options:
+            if config[full_name][option] not in preseeds:
+                preseeds.append(config[full_name][option])
+    return preseeds
+
+
 class PreseedMixin(object):
     def get_preseeds(self, bundle):
-        preseeds = []
-        packages = bundle.split(' ')
-        for package in packages:
-            full_name = 'debconf:%s' % package
-            if full_name not in config:
-                continue
-            options = config[full_name]
-            for option in options:
-                preseeds.append(config[full_name][option])
-        return preseeds
+        return get_preseeds(bundle.split())
 
 
 class InstanceMixin(object):
+    @property
+    def inventory(self):
+        if getattr(self.app, 'inventory', None) is None:
+            self.app.inventory = Inventory(self.app.ec2_conn, config.inventory_path, config.inventory_ttl)
+        return self.app.inventory
+
+    @property
+    def instance_index(self):
+        if getattr(self.app, 'instance_index', None) is None:
+            self.app.instance_index = InstanceIndex(self.inventory)
+        return self.app.instance_index
+
+    def invalidate_instances(self, instance_ids):
+        self.inventory.invalidate(instance_ids)
+        self.app.instance_index = None
+
     def get_instance(self, name, arg_is_id=False, raise_error=True):
         if arg_is_id:
-            reservations = self.app.ec2_conn.get_all_instances(instance_ids=[name])
+            instances = self.instance_index.select(Selector(ids=[name], states=None))
         else:
-            reservations = self.app.ec2_conn.get_all_instances(filters={'tag:Name': name})
-            possible_reservations = []
-            for res in reservations:
-                for instance in res.instances:
-                    if instance.state == 'terminated':
-                        pass
-                    else:
-                        possible_reservations.append(res)
-            if len(possible_reservations) > 1:
+            instances = self.instance_index.select(Selector(names=[name]))
+            if len(instances) > 1:
                 raise RuntimeError('More than one reservation returned, use --id!')
-            reservations = possible_reservations
-        if not reservations:
+        if not instances:
             raise RuntimeError('No instances found!')
-        res = reservations[0]
-        if not res.instances:
-            raise RuntimeError('No instances wth name %s!' % name)
-        elif len(res.instances) > 1:
-            raise RuntimeError('More than one instance in reservation!' % name)
 
-        instance = res.instances[0]
+        instance = instances[0]
         return instance
 
-    def get_instances(self, name):
-        regex = re.compile('(.*)-([0-9]+)$')
-        instances = []
-        reservations = self.app.ec2_conn.get_all_instances()
-        for reservation in reservations:
-            for instance in reservation.instances:
-                name_tag = instance.tags.get('Name', '')
-                if name == name_tag:
-                    instances.append(instance)
-                    continue
-                m = regex.match(name_tag)
-                if m and name == m.group(1):
-                    instances.append(instance)
-        return instances
+    def get_instances(self, *names):
+        return self.instance_index.select(Selector(base_names=names))
+
+    def get_instances_by_id(self, instance_ids):
+        return self.instance_index.select(Selector(ids=instance_ids, states=None))
+
+    def get_fresh_instances(self, instance_ids):
+        "Describe the given ids in one call, bypassing any cached state."
+        selector = Selector(ids=instance_ids, states=None)
+        return dict((inst.id, InstanceRecord.from_instance(inst)) for inst in describe(self.app.ec2_conn, selector))
 
     def get_instance_names(self):
         names = set()
-        reservations = self.app.ec2_conn.get_all_instances()
-        for reservation in reservations:
-            for instance in reservation.instances:
-                tag = instance.tags.get('Name', '')
-                if tag:
-                    names.add(tag.split(' [')[0])
+        for instance in self.instance_index.select(Selector()):
+            if instance.name:
+                names.add(instance.name.split(' [')[0])
         return names
 
     def get_project_instances(self, name):
-        instances = []
-        reservations = self.app.ec2_conn.get_all_instances()
-        for reservation in reservations:
-            for instance in reservation.instances:
-                project_tag = instance.tags.get('Project', '')
-                if project_tag and project_tag == name:
-                    instances.append(instance)
-
-        return instances
+        return self.instance_index.select(Selector(project=name))
 
     def get_build_instances(self, name):
-        instances = []
-        reservations = self.app.ec2_conn.get_all_instances()
-        for reservation in reservations:
-            for instance in reservation.instances:
-                build_tag = instance.tags.get('Build', '')
-                if build_tag and build_tag == name:
-                    instances.append(instance)
-        return instances
+        return self.instance_index.select(Selector(build=name))
 
     def get_reservation(self, name, project_name=None, build_name=None):
         tag_name = name.split(' [')[0]
-        reservations = self.app.ec2_conn.get_all_instances()
-        for reservation in reservations:
-            for instance in reservation.instances:
-                inst_tag_name = instance.tags.get('Name', '').split(' [')[0]
-                if inst_tag_name != tag_name:
-                    continue
-                if project_name and instance.tags.get('Project', '') != project_name:
-                    continue
-                if build_name and instance.tags.get('Build', '') != build_name:
-                    continue
-                return reservation
+        selector = Selector(prefixes=[tag_name], project=project_name, build=build_name)
+        for instance in self.instance_index.select(selector):
+            if instance.name.split(' [')[0] != tag_name:
+                continue
+            reservations = self.app.ec2_conn.get_all_reservations(filters={'instance-id': instance.id})
+            if reservations:
+                return reservations[0]
         raise RuntimeError('Reservation not found!')
 
+    def is_name_taken(self, name):
+        return bool(self.instance_index.select(Selector(names=[name])))
+
     def get_user(self, instance):
         keys = config.images.keys()
         for key in keys:
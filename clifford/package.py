@@ -1,5 +1,6 @@
 from collections import OrderedDict
 from commands import BaseCommand
+from groups import compile_groups, group_items
 from main import config
 
 
@@ -73,33 +74,38 @@ class Group(BaseCommand):
             if name in config[section]:
                 raise RuntimeError('%s already exists!' % name)
 
-            group_items = self.get_group_items()
-            if not group_items:
+            items = self.get_group_items()
+            if not items:
                 raise RuntimeError('Nothing to save!\n')
 
-            config[section][name] = group_items
-            config.save()
+            self.save_group(name, items)
 
         else:
             if name not in config[section]:
                 raise RuntimeError('No %s %s found!' % (name, section[:-1]))
 
             if parsed_args.show:
-                for item in config[section][name]:
-                    self.app.stdout.write('[%s] %s\n' % (item['Type'], item['Value']))
+                for item_type, value in group_items(config[section][name]):
+                    self.app.stdout.write('[%s] %s\n' % (item_type, value))
 
             elif parsed_args.update:
-                group_items = self.get_group_items()
-                if not group_items:
+                items = self.get_group_items()
+                if not items:
                     raise RuntimeError('Nothing to save!\n')
 
-                config[section][name] = group_items
-                config.save()
+                self.save_group(name, items)
 
             elif parsed_args.remove:
                 del(config[section][name])
                 config.save()
 
+    def save_group(self, name, items):
+        groups = OrderedDict(config.groups)
+        groups[name] = items
+        compile_groups(groups, config.bundles)
+        config.groups[name] = items
+        config.save()
+
     def get_group_items(self):
         group_items = []
         while True:
@@ -0,0 +1,424 @@
+import os
+import Queue
+import threading
+import time
+import traceback
+from collections import OrderedDict, defaultdict
+from multiprocessing import Manager, Pool
+from multiprocessing.pool import ThreadPool
+
+from activity import (add_user, cache_client, cache_server, ec2_conn, elastic_ip, group_installer, iter_ok,
+                      py_installer, script_runner, static_host, upgrade, wait_ready)
+from engine import remote_engine
+from events import EventLog, emit, reporting
+from groups import compile_groups
+from inventory import InstanceRecord
+from main import config
+from mixins import get_preseeds
+from query import Selector, describe
+
+
+def make_pool(tasks, workers=None, processes=False):
+    """A worker pool for `tasks` concurrent steps, capped at `workers` (config Workers).
+
+    Steps spend their time waiting on SSH and EC2, so the workers are threads
+    and memory stays flat as the fleet grows. Process workers are opt-in, for
+    CPU-heavy steps.
+    """
+    size = max(1, min(tasks, workers or config.workers))
+    remote_engine(workers)
+    if processes or config.worker_processes:
+        return Pool(processes=size)
+    return ThreadPool(processes=size)
+
+
+def timed(func, args, kwargs):
+    "Pool entry point: (ok, result or traceback, started, finished) for one call, so no exception is lost in the pool."
+    started = time.time()
+    try:
+        return True, func(*args, **kwargs), started, time.time()
+    except Exception as e:
+        return False, getattr(e, 'output', None) or traceback.format_exc(), started, time.time()
+
+
+def run_step(func, aws_key_path, task, step=None, reports=None):
+    """Run one step of a task.
+
+    With a reports queue the step's progress goes there as events while it
+    runs: started, its lines, any warnings or errors, and finished.
+    """
+    if reports is None:
+        ok, output, started, finished = timed(func, [aws_key_path, task], {})
+    else:
+        with reporting(reports, (task.instance and task.instance.name) or task.instance_id, step or func.func_name):
+            emit('started')
+            ok, output, started, finished = timed(func, [aws_key_path, task], {})
+            if not ok:
+                emit('error', text=output.strip().splitlines()[-1] + '\n')
+            emit('finished', ok=ok, duration=finished - started)
+    if not ok:
+        output = 'Running %s on %s failed\n%s' % (func.func_name, task.instance_id, output)
+    return ok, output, started, finished
+
+
+def next_event(events):
+    "Block on a queue without making the process deaf to Ctrl-C."
+    while True:
+        try:
+            return events.get(True, 1)
+        except Queue.Empty:
+            continue
+
+
+def completed(pool, calls):
+    """Submit (func, args, kwargs) calls to pool and yield each outcome the moment it is done.
+
+    Outcomes are (index, ok, result or traceback, started, finished), in
+    completion order rather than submission order.
+    """
+    events = Queue.Queue()
+    for index, (func, args, kwargs) in enumerate(calls):
+        pool.apply_async(timed, [func, args, kwargs],
+                         callback=lambda outcome, index=index: events.put((index,) + outcome))
+    for i in range(len(calls)):
+        yield next_event(events)
+
+
+def compiled_group(name):
+    "The named group from config, compiled down to its bundles, repos and PPAs."
+    if name not in config.groups:
+        raise RuntimeError('No group named %s!' % name)
+    return compile_groups(config.groups, config.bundles)[name]
+
+
+def group_repos(apt_repos, ppas):
+    "Look up the Apt: sections and PPAs a group names; returns (apt repos, ppas) as pairs."
+    repos = []
+    for option in apt_repos:
+        section = 'Apt:%s' % option
+        if section not in config:
+            raise RuntimeError('No apt repo named %s!' % option)
+        repos.append((option, config[section]))
+    found = []
+    for package_name in ppas:
+        ppa_name = config.get('PPAs', {}).get(package_name)
+        if not ppa_name:
+            raise RuntimeError('PPA Name not found!')
+        found.append((package_name, ppa_name))
+    return repos, found
+
+
+def group_preseeds(group, apt_repos, ppas):
+    "Preseeds for every package a group installs, including those from its repos and PPAs."
+    packages = group.packages + [options['package'] for option, options in apt_repos] + [name for name, ppa_name in ppas]
+    return get_preseeds(packages)
+
+
+def build_steps(build, image, tag_name, cache=None):
+    """The bootstrap of one instance of build, as an ordered list of (step name, func, arg_list).
+
+    cache, if given, is the address of the build's package cache, or
+    'localhost' for the instance that runs it.
+    """
+    steps = []
+
+    if build.get('Upgrade', '') in ['upgrade', 'dist-upgrade']:
+        steps.append(('upgrade', upgrade, []))
+        if build.get('Upgrade') == 'dist-upgrade':
+            steps.append(('reboot', wait_ready, []))
+
+    cache_at = len(steps)
+    if build.get('Group', '') in config.groups:
+        group = compiled_group(build['Group'])
+        if group.missing:
+            raise RuntimeError('Group %s refers to missing %s!' % (build['Group'], ', '.join(group.missing)))
+        apt_repos, ppas = group_repos(group.apt_repos, group.ppas)
+        if group.bundles or apt_repos or ppas:
+            steps.append(('group', group_installer, [group.bundles, group_preseeds(group, apt_repos, ppas), apt_repos, ppas]))
+
+    if build.get('PyGroup', '') in config.python_bundles:
+        python_packages = config.python_bundles[build['PyGroup']]
+        if python_packages:
+            steps.append(('pip', py_installer, [config['PythonInstaller'], python_packages, cache == 'localhost']))
+
+    if cache and len(steps) > cache_at:
+        if cache == 'localhost':
+            steps.insert(cache_at, ('cache', cache_server, []))
+        else:
+            steps.insert(cache_at, ('cache', cache_client, [cache]))
+
+    if 'Script' in build:
+        steps.append(('script', script_runner, [image['Login'], os.path.join(config.script_path, build['Script']), False]))
+
+    if 'Adduser' in build:
+        steps.append(('adduser', add_user, [config.pub_key_path]))
+        if 'Script' in build['Adduser']:
+            steps.append(('user_script', script_runner, [build['Adduser']['User'], os.path.join(config.script_path, build['Adduser']['Script']), True]))
+
+    if 'ElasticIP' in build:
+        steps.append(('elastic_ip', elastic_ip, []))
+    elif 'StaticHost' not in build or build['StaticHost'] != 'skip':
+        steps.append(('static_host', static_host, [tag_name]))
+
+    return steps
+
+
+def cache_node(build, instance_ids, instances, enabled=False):
+    """The instance to run a build's package cache on and its private address.
+
+    Only builds of more than one instance that ask for a cache get one;
+    otherwise returns (None, None).
+    """
+    found = [inst_id for inst_id in instance_ids if inst_id in instances]
+    if not (enabled or build.get('Cache')) or len(found) < 2:
+        return None, None
+    return found[0], instances[found[0]].private_ip_address
+
+
+def cache_for(inst_id, server, address):
+    "The cache argument build_steps takes for inst_id."
+    if server is None:
+        return None
+    return 'localhost' if inst_id == server else address
+
+
+def share_cache(scheduler, server, chain):
+    """Hold every instance's package steps until the cache node has run them.
+
+    The cache node fetches each deb and builds each wheel once, the rest
+    then install from its copy. chain is a list of (instance id, step names).
+    """
+    server_steps = dict(chain)[server]
+    for inst_id, step_names in chain:
+        if inst_id == server:
+            continue
+        for step in ['cache', 'group', 'pip']:
+            if step in step_names and step in server_steps:
+                scheduler.depend((inst_id, step), [(server, step)])
+
+
+def parse_limits(limits, overrides):
+    "Per-step concurrency caps from config, overridden by STEP=N values from the command line."
+    limits = dict(limits)
+    for limit in overrides:
+        step, _, count = limit.partition('=')
+        if not count.isdigit():
+            raise RuntimeError('Limits look like step=N, e.g. upgrade=5')
+        limits[step] = int(count)
+    return limits
+
+
+def project_order(project, tag_name):
+    """Check the ordering between a project's builds and return it per build.
+
+    A project build may list other builds it waits on, e.g.
+    {"Build": "web", "After": [{"Build": "db", "Before": "script"}]} holds
+    each web instance's script step (and everything after it) until every db
+    instance is done. "Step" waits on one step of the other build instead of
+    its whole bootstrap, and leaving out "Before" holds the whole bootstrap.
+    """
+    step_names = {}
+    order = OrderedDict()
+    for project_build in project['Builds']:
+        build = config.builds[project_build['Build']]
+        image = config.images[build['Image']]
+        step_names[project_build['Build']] = [step[0] for step in build_steps(build, image, tag_name)]
+        order.setdefault(project_build['Build'], []).extend(project_build.get('After', []))
+
+    for name, afters in order.items():
+        for after in afters:
+            if after.get('Build') not in order:
+                raise RuntimeError('%s waits on %s, which is not in the project!' % (name, after.get('Build')))
+            if after.get('Step') not in (None, 'ready') and after['Step'] not in step_names[after['Build']]:
+                raise RuntimeError('%s has no %s step to wait on!' % (after['Build'], after['Step']))
+            if after.get('Before') is not None and after['Before'] not in step_names[name]:
+                raise RuntimeError('%s has no %s step to hold back!' % (name, after['Before']))
+
+    done = set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in path:
+            raise RuntimeError('Build ordering loops: %s' % ' -> '.join(path + [name]))
+        for after in order[name]:
+            visit(after['Build'], path + [name])
+        done.add(name)
+
+    for name in order:
+        visit(name, [])
+    return order
+
+
+class Scheduler(object):
+    """Run a DAG of per-instance steps on a worker pool.
+
+    Nodes are (instance_id, step name) pairs. A node is submitted as soon as
+    every node it comes after has finished, so one slow host never holds up
+    the others. Gates are nodes released from outside the pool, e.g. when an
+    instance passes its status checks. Limits cap how many nodes with a given
+    step name run at once.
+    """
+
+    def __init__(self, pool, aws_key_path, out, limits=None):
+        self.pool = pool
+        self.aws_key_path = aws_key_path
+        self.out = out
+        self.limits = limits or {}
+        self.nodes = OrderedDict()
+        self.requires = {}
+        self.waiting_on = OrderedDict()
+        self.dependents = defaultdict(list)
+        self.running = defaultdict(int)
+        self.ready = []
+        self.finished = set()
+        self.failed = set()
+        self.timings = {}
+        self.events = Queue.Queue()
+        self.reports = Queue.Queue() if isinstance(pool, ThreadPool) else Manager().Queue()
+
+    def add(self, node, func, task, after=()):
+        self.nodes[node] = (func, task)
+        self.depend(node, after)
+
+    def gate(self, node, after=()):
+        self.nodes[node] = None
+        self.depend(node, after)
+
+    def depend(self, node, after):
+        self.requires.setdefault(node, set()).update(after)
+        self.waiting_on.setdefault(node, set()).update(after)
+        for dependency in after:
+            self.dependents[dependency].append(node)
+
+    def add_chain(self, instance_id, steps, task, after=()):
+        "Add steps to run one after another on an instance; returns the last node."
+        for name, func, arg_list in steps:
+            node = (instance_id, name)
+            self.add(node, func, task._replace(arg_list=arg_list), after)
+            after = [node]
+        return after[0] if after else None
+
+    def release(self, node, ok=True, output='', instance=None):
+        """Finish a gate; safe to call from any thread.
+
+        instance, if given, replaces the record in the tasks of that
+        instance's steps. They all wait on the gate, so none has started.
+        """
+        if instance is not None:
+            for waiting, entry in self.nodes.items():
+                if entry is not None and waiting[0] == node[0]:
+                    self.nodes[waiting] = (entry[0], entry[1]._replace(instance=instance))
+        self.events.put((node, ok, output, None))
+
+    def submit(self, node):
+        func, task = self.nodes[node]
+        self.running[node[1]] += 1
+        self.out.write('==>%s starting: %s\n' % (func.func_name, task.instance_id))
+        self.pool.apply_async(run_step, [func, self.aws_key_path, task, node[1], self.reports],
+                              callback=lambda outcome: self.events.put((node, outcome[0], outcome[1], outcome[2:])))
+
+    def dispatch(self):
+        while True:
+            unblocked = [node for node, deps in self.waiting_on.items() if not deps]
+            if not unblocked:
+                break
+            for node in unblocked:
+                del self.waiting_on[node]
+                if self.requires[node] & self.failed:
+                    self.report_skipped(node)
+                    self.complete(node, False, 'Skipping %s on %s\n' % (node[1], node[0]))
+                elif self.nodes[node] is not None:
+                    self.ready.append(node)
+
+        blocked = []
+        for node in self.ready:
+            limit = self.limits.get(node[1])
+            if limit and self.running[node[1]] >= limit:
+                blocked.append(node)
+            else:
+                self.submit(node)
+        self.ready = blocked
+
+    def report_skipped(self, node):
+        if self.nodes[node] is not None:
+            task = self.nodes[node][1]
+            self.reports.put({'event': 'skipped', 'host': task.instance.name if task.instance else node[0],
+                              'step': node[1], 'time': time.time()})
+
+    def complete(self, node, ok, output):
+        (self.finished if ok else self.failed).add(node)
+        if output:
+            self.out.write('-------------------------\n')
+            self.out.write(output)
+        for dependent in self.dependents.get(node, []):
+            if dependent in self.waiting_on:
+                self.waiting_on[dependent].discard(node)
+
+    def run(self):
+        event_log = EventLog(self.reports)
+        event_log.start()
+        try:
+            self.wait()
+        except KeyboardInterrupt:
+            remote_engine().cancel()
+            raise
+        finally:
+            event_log.stop()
+        self.out.write('-------------------------\n')
+        self.summary()
+        return not self.failed
+
+    def wait(self):
+        self.dispatch()
+        while len(self.finished) + len(self.failed) < len(self.nodes):
+            node, ok, output, timing = next_event(self.events)
+            if node in self.finished or node in self.failed:
+                continue
+            if self.nodes[node] is None:
+                self.waiting_on.pop(node, None)
+            else:
+                self.running[node[1]] -= 1
+                self.timings[node] = timing
+                output += '<==%s %s: %s in %.1fs\n' % (node[1], 'finished' if ok else 'failed', node[0], timing[1] - timing[0])
+            self.complete(node, ok, output)
+            self.dispatch()
+
+    def summary(self):
+        "One line per step: how many instances ran it and the span from first start to last finish."
+        spans = OrderedDict()
+        for node, (started, finished) in sorted(self.timings.items(), key=lambda item: item[1]):
+            span = spans.setdefault(node[1], [0, started, finished])
+            span[0] += 1
+            span[1] = min(span[1], started)
+            span[2] = max(span[2], finished)
+        for name, (count, started, finished) in spans.items():
+            self.out.write('%-12s %3d  %s - %s  %.1fs\n' % (name, count,
+                                                            time.strftime('%H:%M:%S', time.localtime(started)),
+                                                            time.strftime('%H:%M:%S', time.localtime(finished)),
+                                                            finished - started))
+
+
+def fresh_record(instance_id):
+    "The instance as EC2 has it now, e.g. with the public DNS name it may have lacked at launch."
+    for instance in describe(ec2_conn(), Selector(ids=[instance_id], states=None)):
+        return InstanceRecord.from_instance(instance)
+    raise RuntimeError('Instance %s not found!' % instance_id)
+
+
+def release_when_ok(scheduler, instance_ids, out):
+    "Release each instance's ready gate, with a fresh record of it, as soon as it passes its status checks."
+    def watch():
+        pending = set(instance_ids)
+        try:
+            for inst_id in iter_ok(instance_ids, out=out):
+                scheduler.release((inst_id, 'ready'), instance=fresh_record(inst_id))
+                pending.discard(inst_id)
+        except Exception as e:
+            for inst_id in pending:
+                scheduler.release((inst_id, 'ready'), False, '%s: %s\n' % (inst_id, e))
+
+    thread = threading.Thread(target=watch)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -1,11 +1,13 @@
-from collections import OrderedDict
-from multiprocessing import Manager, Pool, Queue
-import time
+from collections import OrderedDict, defaultdict
+from multiprocessing import Manager
+import Queue
 
-from activity import Task
-from activity import launcher, upgrade
+from activity import Task, launcher
 from commands import BaseCommand
 from main import config
+from pipeline import (Scheduler, build_steps, cache_for, cache_node, completed, make_pool, parse_limits,
+                      project_order, release_when_ok, share_cache)
+from runlog import run_log
 
 
 class Project(BaseCommand):
@@ -14,7 +16,11 @@ class Project(BaseCommand):
     def get_parser(self, prog_name):
         parser = super(Project, self).get_parser(prog_name)
         parser.add_argument('-a', '--add', action='store_true')
+        parser.add_argument('-c', '--cache', action='store_true')
+        parser.add_argument('-l', '--limit', action='append', default=[], metavar='STEP=N')
+        parser.add_argument('-p', '--processes', action='store_true')
         parser.add_argument('-r', '--remove', action='store_true')
+        parser.add_argument('-w', '--workers', type=int)
         parser.add_argument('project_name')
         return parser
 
@@ -43,15 +49,18 @@ class Project(BaseCommand):
             self.app.stdout.write('Clifford Tag Names may not include brackets')
             return
 
+        order = project_order(project, tag_name)
+
         if not self.sure_check():
             return
 
+        self.app.stdout.write('Logging to %s\n' % run_log().path)
         total = sum(b['Num'] for b in project['Builds'])
-        pool = Pool(processes=total)
-        m = Manager()
-        q = m.Queue(total)
+        processes = parsed_args.processes or config.worker_processes
+        pool = make_pool(total, parsed_args.workers, processes)
+        q = Manager().Queue(total) if processes else Queue.Queue(total)
 
-        results = []
+        launches = []
         counter = 0
         for project_build in project['Builds']:
             build = config.builds[project_build['Build']]
@@ -66,56 +75,49 @@ class Project(BaseCommand):
                 'counter': counter,
                 'q': q
             }
-            results.append(pool.apply_async(launcher, [tag_name, config.aws_key_path, config.script_path], kwargs))
+            launches.append((launcher, [tag_name, config.aws_key_path, config.script_path], kwargs))
             counter += project_build['Num']
-        launch_results = self.process_results(q, results)
-
-        tasks = []
-        for lr in launch_results:
-            if lr.build.get('Upgrade', '') in ['upgrade', 'dist-upgrade']:
-                for inst_id in lr.instance_ids:
-                    tasks.append(Task(lr.build, lr.image, inst_id, []))
-        self.run_activity(pool, upgrade, tasks)
-        self.app.stdout.write('Upgrade Finished\n')
-
-        '''
-        instances = []
+        launch_results = self.process_results(q, completed(pool, launches), launches)
         for lr in launch_results:
-            if lr.build.get('Upgrade', '') in ['upgrade', 'dist-upgrade']:
-                reservations = self.app.ec2_conn.get_all_instances(instance_ids=lr.instance_ids)
-                for res in reservations:
-                    for inst in res.instances:
-                        instances.append(inst)
-
-
+            self.invalidate_instances(lr.instance_ids)
 
+        instances = self.get_fresh_instances([inst_id for lr in launch_results for inst_id in lr.instance_ids])
+        scheduler = Scheduler(pool, config.aws_key_path, self.app.stdout,
+                              parse_limits(project.get('Limits', {}), parsed_args.limit))
+        chains = defaultdict(list)
         for lr in launch_results:
-            reservations = self.app.ec2_conn.get_all_instances(instance_ids=lr.instance_ids)
-
-            if 'Upgrade' in lr.build and lr.build['Upgrade'] in ['upgrade', 'dist-upgrade']:
-                self.run_activity(lr.reservation, pool, upgrade, [lr.image['Login'], lr.build['Upgrade'], config.aws_key_path])
-
-            if 'Group' in lr.build and lr.build['Group'] in config.groups:
-                bundles = []
-                self.get_bundles(lr.build['Group'], bundles)
-                self.run_activity(reservation, pool, group_installer, [lr.image['Login'], bundles, config.aws_key_path])
-                self.app.stdout.write('Group Installer Finished\n')
-                time.sleep(10)
-
-            if 'PyGroup' in lr.build and lr.build['PyGroup'] in config.python_bundles:
-                python_packages = config.python_bundles[lr.build['PyGroup']]
-                self.app.stdout.write('python: %s [%s]\n' % (lr.build['PyGroup'], python_packages))
-
-                self.run_activity(reservation, pool, py_installer, [lr.image['Login'], python_packages, config.aws_key_path])
-                self.app.stdout.write('Python Installer Finished\n')
-                time.sleep(10)
-
-            if 'Script' in lr.build:
-                self.run_activity(reservation, pool, script_runner, [lr.image['Login'], os.path.join(config.script_path, lr.build['Script']), config.aws_key_path])
-        '''
+            server, address = cache_node(lr.build, lr.instance_ids, instances, parsed_args.cache)
+            chain = []
+            for inst_id in lr.instance_ids:
+                steps = build_steps(lr.build, lr.image, tag_name, cache_for(inst_id, server, address))
+                ready = (inst_id, 'ready')
+                scheduler.gate(ready)
+                chain.append((inst_id, [step[0] for step in steps]))
+                if inst_id not in instances:
+                    scheduler.release(ready, False, '==>skipping: %s not found\n' % inst_id)
+                task = Task(lr.build, lr.image, inst_id, [], instances.get(inst_id))
+                scheduler.add_chain(inst_id, steps, task, after=[ready])
+            chains[lr.build_name].extend(chain)
+            if server:
+                share_cache(scheduler, server, chain)
+
+        for build_name, afters in order.items():
+            for after in afters:
+                waits = []
+                for inst_id, step_names in chains[after['Build']]:
+                    waits.append((inst_id, after.get('Step') or (step_names[-1] if step_names else 'ready')))
+                for inst_id, step_names in chains[build_name]:
+                    if step_names:
+                        scheduler.depend((inst_id, after.get('Before') or step_names[0]), waits)
+
+        self.app.stdout.write('Allowing servers to come up...\n')
+        release_when_ok(scheduler, instances.keys(), self.app.stdout)
+        ok = scheduler.run()
 
         pool.close()
         pool.join()
+        if not ok:
+            raise RuntimeError('Project finished with failed steps!')
 
         '''
         instance = self.get_instance(parsed_args.name)
@@ -142,42 +144,21 @@ class Project(BaseCommand):
             self.app.run_subcommand(cmd.split(' '))
         '''
 
-    def process_results(self, q, results):
-        launch_results = []
-        completed = []
-        while results:
-            time.sleep(20)
-            for result in results:
-                if result.ready():
-                    launch_results.append(q.get())
-                    self.app.stdout.write('-------------------------\n')
-                    self.app.stdout.write(result.get().getvalue())
-                    completed.append(result)
-            results = [result for result in results if result not in completed]
-            if not results:
-                break
-        self.app.stdout.write('-------------------------\n')
-        return launch_results
-
-    def run_activity(self, pool, func, tasks):
-        results = []
-        for task in tasks:
-            self.app.stdout.write('==>%s starting: %s\n' % (func.func_name, task.instance_id))
-            results.append(pool.apply_async(func, [config.aws_key_path, task]))
-
-        completed = []
-        while results:
-            time.sleep(20)
-            for result in results:
-                if result.ready():
-                    self.app.stdout.write('-------------------------\n')
-                    self.app.stdout.write(result.get())
-                    completed.append(result)
-            results = [result for result in results if result not in completed]
-            if not results:
-                break
+    def process_results(self, q, outcomes, launches):
+        for index, ok, output, started, finished in outcomes:
+            self.app.stdout.write('-------------------------\n')
+            self.app.stdout.write(output.getvalue() if ok else output)
+            self.app.stdout.write('<==launch %s: %s in %.1fs\n' % ('finished' if ok else 'failed',
+                                                                  launches[index][2]['build_name'], finished - started))
         self.app.stdout.write('-------------------------\n')
 
+        launch_results = []
+        while True:
+            try:
+                launch_results.append(q.get_nowait())
+            except Queue.Empty:
+                return launch_results
+
     def add(self, name):
         project = OrderedDict()
         project['Builds'] = []
@@ -0,0 +1,122 @@
+import re
+
+
+LIVE_STATES = ('pending', 'running', 'shutting-down', 'stopping', 'stopped')
+SUFFIX_REGEX = re.compile('(.*)-([0-9]+)$')
+PAGE_SIZE = 1000
+
+
+def base_name(name):
+    m = SUFFIX_REGEX.match(name)
+    if m:
+        return m.group(1)
+    return name
+
+
+def fold_names(names):
+    "Compress names for display, e.g. web-1, web-2, web-3, db into web-[1-3], db."
+    numbered = {}
+    folded = []
+    for name in names:
+        m = SUFFIX_REGEX.match(name)
+        if m and str(int(m.group(2))) == m.group(2):
+            if m.group(1) not in numbered:
+                numbered[m.group(1)] = []
+                folded.append((m.group(1), True))
+            numbered[m.group(1)].append(int(m.group(2)))
+        else:
+            folded.append((name, False))
+
+    parts = []
+    for name, is_numbered in folded:
+        if not is_numbered:
+            parts.append(name)
+            continue
+        numbers = sorted(set(numbered[name]))
+        if len(numbers) == 1:
+            parts.append('%s-%d' % (name, numbers[0]))
+            continue
+        ranges = []
+        start = prev = numbers[0]
+        for number in numbers[1:]:
+            if number != prev + 1:
+                ranges.append((start, prev))
+                start = number
+            prev = number
+        ranges.append((start, prev))
+        parts.append('%s-[%s]' % (name, ','.join('%d' % low if low == high else '%d-%d' % (low, high)
+                                                 for low, high in ranges)))
+    return ', '.join(parts)
+
+
+class Selector(object):
+    "A set of instances, expressed as EC2 filters plus whatever has to be matched locally."
+
+    def __init__(self, ids=None, names=None, base_names=None, prefixes=None,
+                 project=None, build=None, states=LIVE_STATES):
+        self.ids = list(ids or [])
+        self.names = list(names or [])
+        self.base_names = list(base_names or [])
+        self.prefixes = list(prefixes or [])
+        self.project = project
+        self.build = build
+        self.states = list(states) if states else None
+
+    def filters(self):
+        filters = {}
+        if self.ids:
+            filters['instance-id'] = self.ids
+        name_values = list(self.names)
+        for name in self.base_names:
+            name_values.extend([name, '%s-*' % name])
+        name_values.extend(['%s*' % prefix for prefix in self.prefixes])
+        if name_values:
+            filters['tag:Name'] = name_values
+        if self.project:
+            filters['tag:Project'] = self.project
+        if self.build:
+            filters['tag:Build'] = self.build
+        if self.states:
+            filters['instance-state-name'] = self.states
+        return filters
+
+    def has_name(self):
+        return bool(self.names or self.base_names or self.prefixes)
+
+    def match(self, instance_id, state, tags):
+        if self.ids and instance_id not in self.ids:
+            return False
+        if self.states and state not in self.states:
+            return False
+        if self.project and tags.get('Project', '') != self.project:
+            return False
+        if self.build and tags.get('Build', '') != self.build:
+            return False
+        if self.has_name():
+            name = tags.get('Name', '')
+            if name in self.names:
+                return True
+            # `web-*` on the server also matches `web-db`; only `web` and `web-N` belong to `web`
+            if name in self.base_names or base_name(name) in self.base_names:
+                return True
+            return any(name.startswith(prefix) for prefix in self.prefixes)
+        return True
+
+    def matches(self, instance):
+        return self.match(instance.id, instance.state, instance.tags)
+
+
+def describe(conn, selector):
+    "Yield the instances selected, a page at a time, with filtering pushed down to EC2."
+    next_token = None
+    while True:
+        reservations = conn.get_all_reservations(filters=selector.filters(),
+                                                 max_results=PAGE_SIZE,
+                                                 next_token=next_token)
+        for reservation in reservations:
+            for instance in reservation.instances:
+                if selector.matches(instance):
+                    yield instance
+        next_token = getattr(reservations, 'next_token', None)
+        if not next_token:
+            break
@@ -1,12 +1,36 @@
 import glob
-import time
-from subprocess import call
-
-import paramiko
-
-from commands import BaseCommand
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from activity import ec2_conn
+from apt import NOTES, add_apt_repo, add_ppa, add_repos, apt_install, apt_update, install_bundles, print_result
+from commands import BaseCommand, FleetCommand
 from main import config
 from mixins import PreseedMixin
+from pipeline import compiled_group, group_preseeds, group_repos
+from query import fold_names
+from runlog import TAIL_LINES, run_log
+from transfer import describe_transfer, push_all
+from ssh import ssh_sessions
+
+
+def update_and_install(host, package, out):
+    apt_update(host, out)
+
+    cmd = 'apt-get -y install %s' % package
+    print_result(host.run('sudo su -c "env DEBIAN_FRONTEND=noninteractive %s 2>&1"' % cmd), out)
+
+
+def add_apt_install(host, option, out):
+    apt_repos, ppas = group_repos([option], [])
+    update_and_install(host, add_apt_repo(host, apt_repos[0], out), out)
+
+
+def ppa_install(host, package_name, out):
+    apt_repos, ppas = group_repos([], [package_name])
+    update_and_install(host, add_ppa(host, ppas[0], out), out)
 
 
 class AddAptInstall(BaseCommand):
@@ -21,123 +45,67 @@ class AddAptInstall(BaseCommand):
 
     def take_action(self, parsed_args):
         instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
-        section = 'Apt:%s' % parsed_args.option
-
-        if section not in config:
-            raise RuntimeError('No apt repo named %s!' % parsed_args.option)
-        options = config[section]
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
-
-        if 'keyserver' in options:
-            stdin, stdout, stderr = ssh.exec_command('sudo apt-key adv --keyserver keyserver.ubuntu.com --recv %s 2>&1' % options['keyserver'])
-            self.printOutError(stdout, stderr)
-        elif 'publickey' in options:
-            key = config[section]['publickey']
-            stdin, stdout, stderr = ssh.exec_command('wget %s 2>&1' % key)
-            self.printOutError(stdout, stderr)
-            time.sleep(2)
-            stdin, stdout, stderr = ssh.exec_command('sudo apt-key add %s 2>&1' % key.split('/').pop())
-            self.printOutError(stdout, stderr)
-        else:
-            raise RuntimeError('Invalid apt section!')
-
-        package = config[section]['package']
-        time.sleep(5)
-        stdin, stdout, stderr = ssh.exec_command('sudo su -c "echo \'deb %s\' > /etc/apt/sources.list.d/%s.list"' % (config[section]['deb'], package))
+        add_apt_install(self.get_remote(instance), parsed_args.option, self.app.stdout)
 
-        stdin, stdout, stderr = ssh.exec_command('sudo apt-get -y update 2>&1')
-        self.printOutError(stdout, stderr)
-        time.sleep(5)
-        self.app.stdout.write('UPDATED\n')
 
-        cmd = 'apt-get -y install %s' % package
-        stdin, stdout, stderr = ssh.exec_command('sudo su -c "env DEBIAN_FRONTEND=noninteractive %s 2>&1"' % cmd)
-        self.printOutError(stdout, stderr)
-
-        ssh.close()
-
-
-class AptGetInstall(BaseCommand, PreseedMixin):
-    "Install packages on a remote ec2 instance."
-
-    def get_parser(self, prog_name):
-        parser = super(AptGetInstall, self).get_parser(prog_name)
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
-        return parser
+class AptGetInstall(FleetCommand, PreseedMixin):
+    "Install packages on remote ec2 instances."
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
+        instances = self.get_targets(parsed_args)
 
         packages = raw_input('Enter name of packages to install: ')
         if not packages:
             raise RuntimeError('No packages specified!')
 
-        if self.sure_check():
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
-
+        if self.sure_targets(instances):
             preseeds = self.get_preseeds(packages)
-            cmd = 'apt-get -y install %s' % packages
-            if preseeds:
-                stdin, stdout, stderr = ssh.exec_command('cat << EOF | sudo debconf-set-selections\n%s\nEOF' % '\n'.join(preseeds))
-                stdin, stdout, stderr = ssh.exec_command('sudo su -c "env DEBIAN_FRONTEND=noninteractive %s"' % cmd)
-            else:
-                stdin, stdout, stderr = ssh.exec_command('sudo %s' % cmd)
-            for line in stdout.readlines():
-                if any([item in line for item in ['Note, selecting', 'is already the newest version']]):
-                    self.app.stdout.write(line)
-            has_error = False
-            for line in stderr.readlines():
-                if line.startswith('E: '):
-                    self.app.stdout.write(line)
-                    has_error = True
-            if not has_error:
-                self.app.stdout.write('Installed %s\n' % packages)
-            ssh.close()
-
-
-class BundleInstall(BaseCommand):
-    "Install a bundle on a remote ec2 instance."
+            self.fan_out(instances, lambda instance, out: self.install(instance, out, packages, preseeds), parsed_args.workers)
+
+    def install(self, instance, out, packages, preseeds):
+        result = apt_install(self.get_remote(instance), packages, preseeds)
+        for line in result.stdout:
+            if any([item in line for item in NOTES]):
+                out.write(line)
+        has_error = False
+        for line in result.stderr:
+            if line.startswith('E: '):
+                out.write(line)
+                has_error = True
+        if has_error:
+            raise RuntimeError('Unable to install %s' % packages)
+        out.write('Installed %s\n' % packages)
+
+
+class BundleInstall(FleetCommand, PreseedMixin):
+    "Install a bundle on remote ec2 instances."
 
     def get_parser(self, prog_name):
         parser = super(BundleInstall, self).get_parser(prog_name)
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
         parser.add_argument('option')
         return parser
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
+        instances = self.get_targets(parsed_args)
         bundle = config.bundles[parsed_args.option]
 
-        if self.sure_check():
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
-
+        if self.sure_targets(instances):
             preseeds = self.get_preseeds(bundle)
-            cmd = 'apt-get -y install %s' % bundle
-            if preseeds:
-                stdin, stdout, stderr = ssh.exec_command('cat << EOF | sudo debconf-set-selections\n%s\nEOF' % '\n'.join(preseeds))
-                stdin, stdout, stderr = ssh.exec_command('sudo su -c "env DEBIAN_FRONTEND=noninteractive %s"' % cmd)
-            else:
-                stdin, stdout, stderr = ssh.exec_command('sudo %s' % cmd)
-            for line in stdout.readlines():
-                if 'is already the newest version' in line:
-                    self.app.stdout.write(line)
-            has_error = False
-            for line in stderr.readlines():
-                if line.startswith('E: '):
-                    self.app.stdout.write(line)
-                    has_error = True
-            if not has_error:
-                self.app.stdout.write('Installed bundle %s\n' % parsed_args.option)
-            ssh.close()
+            self.fan_out(instances, lambda instance, out: self.install(instance, out, parsed_args.option, bundle, preseeds), parsed_args.workers)
+
+    def install(self, instance, out, bundle_name, bundle, preseeds):
+        result = apt_install(self.get_remote(instance), bundle, preseeds)
+        for line in result.stdout:
+            if any([item in line for item in NOTES]):
+                out.write(line)
+        has_error = False
+        for line in result.stderr:
+            if line.startswith('E: '):
+                out.write(line)
+                has_error = True
+        if has_error:
+            raise RuntimeError('Unable to install bundle %s' % bundle_name)
+        out.write('Installed bundle %s\n' % bundle_name)
 
 
 class AddUser(BaseCommand):
@@ -176,9 +144,7 @@ class AddUser(BaseCommand):
                 self.app.stdout.write(key + '\n')
 
         if parsed_args.assume_yes or self.sure_check():
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
+            host = self.get_remote(instance)
 
             contents = ''
             for key in keys:
@@ -190,123 +156,136 @@ class AddUser(BaseCommand):
             if parsed_args.group:
                 cmd += ' --ingroup %s' % parsed_args.group
             cmd += ' --gecos "%s" %s' % (fullname, user)
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-            self.printOutError(stdout, stderr)
+            self.printOutError(host.run(cmd))
 
             if not parsed_args.no_keys:
-                stdin, stdout, stderr = ssh.exec_command('sudo su -c "mkdir /home/%s/.ssh && chown %s:users /home/%s/.ssh && chmod 700 /home/%s/.ssh"' % (user, user, user, user))
-                self.printOutError(stdout, stderr)
+                self.printOutError(host.run('sudo su -c "mkdir /home/%s/.ssh && chown %s:users /home/%s/.ssh && chmod 700 /home/%s/.ssh"' % (user, user, user, user)))
 
-                stdin, stdout, stderr = ssh.exec_command('sudo su -c "cat << EOF > /home/%s/.ssh/authorized_keys\n%sEOF"' % (user, contents))
-                self.printOutError(stdout, stderr)
+                self.printOutError(host.run('sudo su -c "cat << EOF > /home/%s/.ssh/authorized_keys\n%sEOF"' % (user, contents)))
 
-                stdin, stdout, stderr = ssh.exec_command('sudo su -c "chown %s:users /home/%s/.ssh/authorized_keys; chmod 600 /home/%s/.ssh/authorized_keys"' % (user, user, user))
-                self.printOutError(stdout, stderr)
+                self.printOutError(host.run('sudo su -c "chown %s:users /home/%s/.ssh/authorized_keys; chmod 600 /home/%s/.ssh/authorized_keys"' % (user, user, user)))
 
-            ssh.close()
 
+class Exec(FleetCommand):
+    "Run a shell command on every matching instance in parallel."
 
-class GroupInstall(BaseCommand):
-    "Install a group of bundles on a remote ec2 instance."
+    def get_parser(self, prog_name):
+        parser = super(Exec, self).get_parser(prog_name)
+        parser.add_argument('-y', dest='assume_yes', action='store_true')
+        parser.add_argument('-q', '--quiet', action='store_true')
+        parser.add_argument('--user')
+        parser.add_argument('--timeout', type=int)
+        parser.add_argument('command')
+        return parser
+
+    def take_action(self, parsed_args):
+        instances = self.get_targets(parsed_args)
+        if not (parsed_args.assume_yes or self.sure_targets(instances)):
+            return
+
+        width = max(len(instance.name) for instance in instances)
+        lock = threading.Lock()
+
+        def run(instance):
+            # only a tail of the output is kept, so hosts are compared on digests of all of it
+            digests = (hashlib.sha1(), hashlib.sha1())
+
+            def stream(line, is_stderr):
+                digests[is_stderr].update(line)
+                if not parsed_args.quiet:
+                    with lock:
+                        self.app.stdout.write('%-*s %s %s' % (width, instance.name, '!' if is_stderr else ':', line))
+
+            host = self.get_remote(instance, parsed_args.user, with_key=not parsed_args.user, timeout=parsed_args.timeout)
+            result = host.run(parsed_args.command, stream=stream, keep=TAIL_LINES)
+            return result, tuple(digest.hexdigest() for digest in digests)
+
+        # hosts whose exit status and output are identical are reported once
+        groups = OrderedDict()
+        tails = {}
+        for index, ok, outcome, started, finished in self.each(instances, run, parsed_args.workers):
+            if ok:
+                result, digests = outcome
+                key = (result.status, 'exit %s' % result.status) + digests
+                tails.setdefault(key, (result.stdout, result.stderr))
+            else:
+                key = (None, outcome.strip().splitlines()[-1], None, None)
+                tails.setdefault(key, ([], []))
+            groups.setdefault(key, []).append(instances[index].name)
+
+        for key, names in sorted(groups.items(), key=lambda item: -len(item[1])):
+            stdout, stderr = tails[key]
+            self.app.stdout.write('-------------------------\n')
+            self.app.stdout.write('%s (%d): %s\n' % (fold_names(names), len(names), key[1]))
+            for line in stdout:
+                self.app.stdout.write(line if line.endswith('\n') else line + '\n')
+            for line in stderr:
+                self.app.stdout.write('ERROR: %s' % (line if line.endswith('\n') else line + '\n'))
+        self.app.stdout.write('-------------------------\n')
+
+        failed = sum(len(names) for key, names in groups.items() if key[0] != 0)
+        if failed:
+            raise RuntimeError('%d of %d hosts failed!' % (failed, len(instances)))
+
+
+class GroupInstall(FleetCommand, PreseedMixin):
+    "Install a group of bundles on remote ec2 instances."
 
     def get_parser(self, prog_name):
         parser = super(GroupInstall, self).get_parser(prog_name)
         parser.add_argument('-y', dest='assume_yes', action='store_true')
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
         parser.add_argument('option')
         return parser
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
-
-        group = config.groups[parsed_args.option]
-        bundle_names = group.split(' ')
-
-        if bundle_names and (parsed_args.assume_yes or self.sure_check()):
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
-
-            has_error = False
-            for bundle_name in bundle_names:
-                if bundle_name in config.bundles:
-                    bundle = config.bundles[bundle_name]
-                else:
-                    if bundle_name.startswith('&'):
-                        cmd = 'remote group install -y'
-                        cmd += ' --id %s' % instance.id
-                        cmd += ' ' + bundle_name[1:]
-                        self.app.run_subcommand(cmd.split(' '))
-                        time.sleep(5)
-                        continue
-                    elif bundle_name.startswith('+'):
-                        cmd = 'remote add-apt install'
-                        cmd += ' --id %s' % instance.id
-                        cmd += ' ' + bundle_name[1:]
-                        self.app.run_subcommand(cmd.split(' '))
-                        time.sleep(5)
-                        continue
-                    elif bundle_name.startswith('@'):
-                        cmd = 'remote ppa install -y'
-                        cmd += ' --id %s' % instance.id
-                        cmd += ' ' + bundle_name[1:]
-                        self.app.run_subcommand(cmd.split(' '))
-                        time.sleep(5)
-                        continue
-
-                    if bundle_name.startswith('$'):
-                        bundle = bundle_name[1:]
-                    else:
-                        self.app.stdout.write('No bundle named %s\n' % bundle_name)
-                        continue
-
-                preseeds = self.get_preseeds(bundle)
-                cmd = 'apt-get -y install %s' % bundle
-                if preseeds:
-                    stdin, stdout, stderr = ssh.exec_command('cat << EOF | sudo debconf-set-selections\n%s\nEOF' % '\n'.join(preseeds))
-                    stdin, stdout, stderr = ssh.exec_command('sudo su -c "env DEBIAN_FRONTEND=noninteractive %s"' % cmd)
-                else:
-                    stdin, stdout, stderr = ssh.exec_command('sudo %s' % cmd)
-                for line in stdout.readlines():
-                    if any([item in line for item in ['Note, selecting', 'is already the newest version']]):
-                        self.app.stdout.write(line)
-                for line in stderr.readlines():
-                    if line.startswith('E: '):
-                        self.app.stdout.write(line)
-                        has_error = True
-                if has_error:
-                    ssh.close()
-                    raise RuntimeError('Unable to continue!')
-                time.sleep(5)
-                self.app.stdout.write('Installed bundle %s\n' % bundle_name)
-            ssh.close()
-
-
-class PyInstall(BaseCommand):
-    "Python install a bundle on a remote ec2 instance."
+        instances = self.get_targets(parsed_args)
+
+        group = compiled_group(parsed_args.option)
+        for name in group.missing:
+            self.app.stdout.write('No bundle named %s\n' % name)
+        apt_repos, ppas = group_repos(group.apt_repos, group.ppas)
+        preseeds = group_preseeds(group, apt_repos, ppas)
+
+        if (group.bundles or apt_repos or ppas) and (parsed_args.assume_yes or self.sure_targets(instances)):
+            self.fan_out(instances, lambda instance, out: self.install(self.get_remote(instance), out, group, apt_repos, ppas, preseeds),
+                         parsed_args.workers)
+
+    def install(self, host, out, group, apt_repos, ppas, preseeds):
+        bundles = group.bundles + add_repos(host, apt_repos, ppas, out)
+        result, failed = install_bundles(host, bundles, preseeds)
+        for line in result.stdout:
+            if any([item in line for item in NOTES]):
+                out.write(line)
+        for bundle_name, lines in failed.items():
+            for line in lines:
+                out.write('%s: %s' % (bundle_name, line))
+        if failed:
+            raise RuntimeError('Unable to continue!')
+        for bundle_name, bundle in bundles:
+            out.write('Installed bundle %s\n' % bundle_name)
+
+
+class PyInstall(FleetCommand):
+    "Python install a bundle on remote ec2 instances."
 
     def get_parser(self, prog_name):
         parser = super(PyInstall, self).get_parser(prog_name)
         parser.add_argument('-y', dest='assume_yes', action='store_true')
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
         parser.add_argument('option')
         return parser
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
+        instances = self.get_targets(parsed_args)
         bundle = config.python_bundles[parsed_args.option]
 
-        if parsed_args.assume_yes or self.sure_check():
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
-            stdin, stdout, stderr = ssh.exec_command('sudo %s %s' % (config['PythonInstaller'], bundle))
-            for line in stdout.readlines():
-                if line.startswith('Installed') or line.startswith('Finished'):
-                    self.app.stdout.write(line)
-            ssh.close()
+        if parsed_args.assume_yes or self.sure_targets(instances):
+            self.fan_out(instances, lambda instance, out: self.install(instance, out, bundle), parsed_args.workers)
+
+    def install(self, instance, out, bundle):
+        result = self.get_remote(instance).run('sudo %s %s' % (config['PythonInstaller'], bundle))
+        for line in result.stdout:
+            if line.startswith('Installed') or line.startswith('Finished'):
+                out.write(line)
 
 
 class PPAInstall(BaseCommand):
@@ -331,62 +310,37 @@ class PPAInstall(BaseCommand):
             options = config['PPAs']
             package_name = self.question_maker('Select PPA', 'ppa', [{'text': item} for item in options])
 
-        ppa_name = config['PPAs'][package_name]
-        if not ppa_name:
-            raise RuntimeError('PPA Name not found!')
-
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
-
-        stdin, stdout, stderr = ssh.exec_command('sudo add-apt-repository -y ppa:%s 2>&1' % ppa_name)
-        self.printOutError(stdout, stderr)
-        time.sleep(5)
-
-        stdin, stdout, stderr = ssh.exec_command('sudo apt-get -y update 2>&1')
-        self.printOutError(stdout, stderr)
-        time.sleep(5)
-        self.app.stdout.write('UPDATED\n')
-
-        cmd = 'apt-get -y install %s' % package_name
-        stdin, stdout, stderr = ssh.exec_command('sudo su -c "env DEBIAN_FRONTEND=noninteractive %s 2>&1"' % cmd)
-        self.printOutError(stdout, stderr)
+        ppa_install(self.get_remote(instance), package_name, self.app.stdout)
 
-        ssh.close()
 
-
-class CopyFile(BaseCommand):
-    "Copy a file to a remote ec2 instance."
+class CopyFile(FleetCommand):
+    "Copy files to remote ec2 instances, skipping those already there."
 
     def get_parser(self, prog_name):
         parser = super(CopyFile, self).get_parser(prog_name)
         parser.add_argument('-y', dest='assume_yes', action='store_true')
         parser.add_argument('--user')
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
-        parser.add_argument('file_name', nargs='+')
+        parser.add_argument('--to', default='')
+        parser.add_argument('-f', '--file', dest='file_name', action='append', required=True)
         return parser
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
-
-        try:
-            if parsed_args.user:
-                retcode = call('scp %s %s@%s:~' % (' '.join(parsed_args.file_name), parsed_args.user, instance.public_dns_name), shell=True)
-            else:
-                retcode = call('scp -i %s/%s.pem %s %s@%s:~' % (config.aws_key_path, instance.key_name, ' '.join(parsed_args.file_name), self.get_user(instance), instance.public_dns_name), shell=True)
+        for file_name in parsed_args.file_name:
+            if not os.path.isfile(file_name):
+                raise RuntimeError('No file named %s!' % file_name)
+        instances = self.get_targets(parsed_args)
 
-            if retcode < 0:
-                self.app.stdout.write("Child was terminated by signal %s\n" % -retcode)
-            else:
-                self.app.stderr.write("Child returned %s\n" % retcode)
+        if parsed_args.assume_yes or self.sure_targets(instances):
+            self.fan_out(instances, lambda instance, out: self.copy(instance, out, parsed_args), parsed_args.workers)
 
-        except OSError as e:
-            self.app.stderr.write("Execution failed: %s\n" % e)
+    def copy(self, instance, out, parsed_args):
+        host = self.get_remote(instance, parsed_args.user, with_key=not parsed_args.user)
+        for transfer in push_all(host, parsed_args.file_name, parsed_args.to):
+            out.write(describe_transfer(transfer))
 
 
-class Script(BaseCommand):
-    "Run a bash script on a remote ec2 instance."
+class Script(FleetCommand):
+    "Run a bash script on remote ec2 instances."
 
     def get_parser(self, prog_name):
         parser = super(Script, self).get_parser(prog_name)
@@ -396,8 +350,6 @@ class Script(BaseCommand):
         parser.add_argument('--user')
         parser.add_argument('--format')
         parser.add_argument('--copy-only', action='store_true')
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
         return parser
 
     def take_action(self, parsed_args):
@@ -411,7 +363,7 @@ class Script(BaseCommand):
                 self.app.stdout.write(contents)
             return
 
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
+        instances = self.get_targets(parsed_args)
 
         if parsed_args.script:
             script_name = parsed_args.script
@@ -421,79 +373,59 @@ class Script(BaseCommand):
             script_name = self.question_maker('Select script', 'script', [{'text': item[len(script_path) + 1:]} for item in scripts])
             script = '%s/%s' % (script_path, script_name)
 
-        if parsed_args.assume_yes or self.sure_check():
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-
-            if parsed_args.user:
-                ssh.connect(instance.public_dns_name, username=parsed_args.user)
-            else:
-                ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
-
-            with open(script, 'r') as f:
-                contents = f.read()
-                if parsed_args.format:
-                    format_args = parsed_args.format.split(',')
-                    contents = contents % tuple(format_args)
-                ssh.exec_command('cat << EOF > %s\n%s\nEOF' % (script_name, contents))
-                ssh.exec_command('chmod 744 %s' % script_name)
+        with open(script, 'r') as f:
+            contents = f.read()
+            if parsed_args.format:
+                format_args = parsed_args.format.split(',')
+                contents = contents % tuple(format_args)
 
-            if not parsed_args.copy_only:
-                channel = ssh.get_transport().open_session()
-                channel.settimeout(0.1)
-                channel.input_enabled = True
-                forward = paramiko.agent.AgentRequestHandler(channel)
+        if parsed_args.assume_yes or self.sure_targets(instances):
+            self.fan_out(instances, lambda instance, out: self.run_script(instance, out, parsed_args, script_name, contents), parsed_args.workers)
 
-                if parsed_args.user:
-                    channel.exec_command('/home/%s/%s' % (parsed_args.user, script_name))
-                else:
-                    channel.exec_command('/home/%s/%s' % (self.get_user(instance), script_name))
-
-                while True:
-                    if channel.exit_status_ready():
-                        break
-                    time.sleep(10)
-                status = channel.recv_exit_status()
-                self.app.stdout.write('Script status: %s\n' % status)
+    def run_script(self, instance, out, parsed_args, script_name, contents):
+        if parsed_args.user:
+            host = self.get_remote(instance, parsed_args.user, with_key=False)
+        else:
+            host = self.get_remote(instance)
 
-                channel.close()
-                forward.close()
+        host.put(script_name, contents, 0o744)
 
-            ssh.close()
+        if not parsed_args.copy_only:
+            result = host.run('/home/%s/%s' % (parsed_args.user or self.get_user(instance), script_name), forward_agent=True,
+                              stream=run_log().stream(instance.name or instance.id, script_name), keep=TAIL_LINES)
+            out.write('Script status: %s\n' % result.status)
+            if result.status:
+                raise RuntimeError('Script exited with status %s' % result.status)
 
 
-class Update(BaseCommand):
-    "Update an ec2 instance."
+class Update(FleetCommand):
+    "Update ec2 instances."
 
     def get_parser(self, prog_name):
         parser = super(Update, self).get_parser(prog_name)
         parser.add_argument('-y', dest='assume_yes', action='store_true')
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
         return parser
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
+        instances = self.get_targets(parsed_args)
 
-        if parsed_args.assume_yes or self.sure_check():
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
+        if parsed_args.assume_yes or self.sure_targets(instances):
+            self.fan_out(instances, self.update, parsed_args.workers)
 
-            has_error = False
-            stdin, stdout, stderr = ssh.exec_command('sudo apt-get -y update')
-            for line in stderr.readlines():
-                if line.startswith('E: '):
-                    self.app.stdout.write(line)
-                    has_error = True
-            if has_error:
-                raise RuntimeError("Unable to continue!")
-            time.sleep(5)
-            self.app.stdout.write('UPDATED\n')
+    def update(self, instance, out):
+        has_error = False
+        result = self.get_remote(instance).run('sudo apt-get -y update')
+        for line in result.stderr:
+            if line.startswith('E: '):
+                out.write(line)
+                has_error = True
+        if has_error:
+            raise RuntimeError("Unable to continue!")
+        out.write('UPDATED\n')
 
 
-class Upgrade(BaseCommand):
-    "Update and upgrade an ec2 instance."
+class Upgrade(FleetCommand):
+    "Update and upgrade ec2 instances."
 
     def get_parser(self, prog_name):
         parser = super(Upgrade, self).get_parser(prog_name)
@@ -501,40 +433,38 @@ class Upgrade(BaseCommand):
         parser.add_argument('--dry-run', action='store_true')
         parser.add_argument('--dist-upgrade', action='store_true')
         parser.add_argument('--reboot', action='store_true')
-        parser.add_argument('--id', dest='arg_is_id', action='store_true')
-        parser.add_argument('name')
         return parser
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name, parsed_args.arg_is_id)
-
-        if parsed_args.assume_yes or self.sure_check():
-            ssh = paramiko.SSHClient()
-            ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(instance.public_dns_name, username=self.get_user(instance), key_filename='%s/%s.pem' % (config.aws_key_path, instance.key_name))
+        instances = self.get_targets(parsed_args)
 
-            if parsed_args.dry_run:
-                cmd = 'sudo apt-get --dry-run %s'
-            else:
-                cmd = 'sudo su -c "env DEBIAN_FRONTEND=noninteractive apt-get -y -o DPkg::Options::=--force-confnew %s"'
-            if parsed_args.dist_upgrade:
-                cmd = cmd % 'dist-upgrade'
-            else:
-                cmd = cmd % 'upgrade'
-
-            stdin, stdout, stderr = ssh.exec_command(cmd)
-            string_list = ['The following packages have been kept back:', 'The following packages will be upgraded:']
-            for line in stdout.readlines():
-                if line.rstrip() in string_list or line.startswith('  '):
-                    self.app.stdout.write(line)
-                for line in stderr.readlines():
-                    if line.startswith('E: '):
-                        self.app.stdout.write(line)
-
-            ssh.close()
-
-            if parsed_args.reboot:
-                time.sleep(5)
-                self.app.stdout.write('Rebooting...\n')
-                instance.reboot()
-                time.sleep(30)
+        if parsed_args.dry_run:
+            cmd = 'sudo apt-get --dry-run %s'
+        else:
+            cmd = 'sudo su -c "env DEBIAN_FRONTEND=noninteractive apt-get -y -o DPkg::Options::=--force-confnew %s"'
+        if parsed_args.dist_upgrade:
+            cmd = cmd % 'dist-upgrade'
+        else:
+            cmd = cmd % 'upgrade'
+
+        if parsed_args.assume_yes or self.sure_targets(instances):
+            try:
+                self.fan_out(instances, lambda instance, out: self.upgrade(instance, out, cmd, parsed_args.reboot), parsed_args.workers)
+            finally:
+                if parsed_args.reboot:
+                    self.invalidate_instances([instance.id for instance in instances])
+
+    def upgrade(self, instance, out, cmd, reboot):
+        result = self.get_remote(instance).run(cmd)
+        string_list = ['The following packages have been kept back:', 'The following packages will be upgraded:']
+        for line in result.stdout:
+            if line.rstrip() in string_list or line.startswith('  '):
+                out.write(line)
+        for line in result.stderr:
+            if line.startswith('E: '):
+                out.write(line)
+
+        if reboot:
+            out.write('Rebooting...\n')
+            ssh_sessions().close(instance.public_dns_name)
+            ec2_conn().reboot_instances([instance.id])
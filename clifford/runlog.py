@@ -0,0 +1,75 @@
+import os
+import re
+import sys
+import threading
+import time
+
+from main import config
+
+
+TAIL_LINES = 200
+
+
+class RunLog(object):
+    """Live output of every host in one clifford run.
+
+    Each line goes to the console prefixed with its host, ':' for stdout and
+    '!' for stderr, and into a log file per host under `path`. Nothing is
+    kept in memory beyond the open files.
+    """
+
+    def __init__(self, path, out=sys.stdout):
+        self.path = path
+        self.out = out
+        self.width = 0
+        self.files = {}
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def log_file(self, label):
+        if self.pid != os.getpid():
+            self.files = {}
+            self.pid = os.getpid()
+        if label not in self.files:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            self.files[label] = open(os.path.join(self.path, '%s.log' % re.sub(r'[^\w.-]', '_', label)), 'a')
+        return self.files[label]
+
+    def write(self, label, line, is_stderr=False, echo=True):
+        with self.lock:
+            f = self.log_file(label)
+            f.write(line)
+            f.flush()
+            if echo:
+                self.width = max(self.width, len(label))
+                self.out.write('%-*s %s %s' % (self.width, label, '!' if is_stderr else ':', line))
+                self.out.flush()
+
+    def stream(self, label, title=None, echo=True):
+        "A stream callback for RemoteHost.run that writes label's lines; title heads the section in the log file."
+        if title:
+            self.write(label, '==> %s\n' % title, echo=False)
+        return lambda line, is_stderr: self.write(label, line, is_stderr, echo)
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files = {}
+
+
+_run_log = None
+_run_log_lock = threading.Lock()
+
+
+def run_log():
+    """The log of this run, created on first use under the config's log path.
+
+    Call it before forking workers so they all write into the same run.
+    """
+    global _run_log
+    with _run_log_lock:
+        if _run_log is None:
+            _run_log = RunLog(os.path.join(config.log_path, '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid())))
+        return _run_log
@@ -12,7 +12,8 @@ class Instance(ShowOne, InstanceMixin):
         return parser
 
     def take_action(self, parsed_args):
-        instance = self.get_instance(parsed_args.name)
+        record = self.get_instance(parsed_args.name)
+        instance = self.app.ec2_conn.get_only_instances(instance_ids=[record.id])[0]
 
         columns = ('Name',
                    'Id',
@@ -0,0 +1,105 @@
+import atexit
+import os
+import threading
+
+
+class SSHSessions(object):
+    "Live SSH connections keyed by (host, user, key file), reused across commands and build phases."
+
+    def __init__(self, keepalive=30):
+        self.keepalive = keepalive
+        self.clients = {}
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def load_key(self, key_filename):
+        "The private key in key_filename, whichever of the types this paramiko knows it is."
+        with self.lock:
+            if key_filename not in self.keys:
+                import paramiko
+                errors = []
+                for key_type in ['RSAKey', 'DSSKey', 'ECDSAKey', 'Ed25519Key']:
+                    key_class = getattr(paramiko, key_type, None)
+                    if key_class is None:
+                        continue
+                    try:
+                        self.keys[key_filename] = key_class.from_private_key_file(key_filename)
+                        break
+                    except paramiko.PasswordRequiredException:
+                        raise
+                    except IOError as e:
+                        raise RuntimeError('Unable to read key %s: %s' % (key_filename, e))
+                    except paramiko.SSHException as e:
+                        errors.append('%s: %s' % (key_type, e))
+                else:
+                    raise RuntimeError('Unable to load key %s (%s)' % (key_filename, '; '.join(errors)))
+            return self.keys[key_filename]
+
+    def get(self, host, username, key_filename=None, log_channel=None):
+        "Return a connected client, opening a new transport only if there is no live one."
+        key = (host, username, key_filename)
+        with self.lock:
+            client = self.clients.get(key)
+        if client is not None:
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                return client
+            self.close(host, username, key_filename)
+
+        import paramiko
+        client = paramiko.SSHClient()
+        if log_channel:
+            client.set_log_channel(log_channel)
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        if key_filename:
+            client.connect(host, username=username, pkey=self.load_key(key_filename),
+                           allow_agent=False, look_for_keys=False)
+        else:
+            client.connect(host, username=username)
+        client.get_transport().set_keepalive(self.keepalive)
+
+        with self.lock:
+            existing = self.clients.get(key)
+            if existing is None:
+                self.clients[key] = client
+                return client
+        client.close()
+        return existing
+
+    def close(self, host, username=None, key_filename=None):
+        "Drop every session to host, or just the one for (username, key_filename)."
+        with self.lock:
+            keys = [key for key in self.clients
+                    if key[0] == host and (username is None or key[1:] == (username, key_filename))]
+            clients = [self.clients.pop(key) for key in keys]
+        for client in clients:
+            client.close()
+
+    def close_all(self):
+        with self.lock:
+            clients = self.clients.values()
+            self.clients = {}
+        for client in clients:
+            client.close()
+
+
+_sessions = (None, None)
+_sessions_lock = threading.Lock()
+
+
+def ssh_sessions():
+    "The session manager for this process; a forked worker never reuses its parent's transports."
+    global _sessions
+    with _sessions_lock:
+        pid, sessions = _sessions
+        if sessions is None or pid != os.getpid():
+            sessions = SSHSessions()
+            _sessions = (os.getpid(), sessions)
+        return sessions
+
+
+@atexit.register
+def _close_sessions():
+    pid, sessions = _sessions
+    if sessions is not None and pid == os.getpid():
+        sessions.close_all()
@@ -1,10 +1,136 @@
 import logging
+import mmap
 import os
+import posixpath
+import StringIO
+import sys
+import threading
+import time
+from itertools import chain
+from multiprocessing.pool import ThreadPool
 
+import boto
 from boto.exception import S3CreateError, S3ResponseError
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 
-from commands import BaseCommand
+from commands import BaseCommand, FleetCommand
+from pipeline import timed
+from transfer import describe_transfer, fetch, local_digest
+
+
+MB = 1024 * 1024
+PART_SIZE = 8 * MB
+MIN_PART_SIZE = 5 * MB
+
+_local = threading.local()
+
+
+def s3_conn():
+    "The S3 connection for this thread; boto connections are not safe to share between threads."
+    if getattr(_local, 'conn', None) is None:
+        _local.conn = boto.connect_s3()
+    return _local.conn
+
+
+def file_parts(filename, part_size):
+    "(part number, file-like part, size) for each part of a file, mapped from disk rather than read into memory."
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        for num, offset in enumerate(range(0, size, part_size), 1):
+            length = min(part_size, size - offset)
+            yield num, mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ, offset=offset), length
+
+
+def stream_parts(fp, part_size):
+    "(part number, file-like part, size) for each part read from a stream such as stdin."
+    num = 0
+    while True:
+        chunks = []
+        remaining = part_size
+        while remaining:
+            chunk = fp.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        if not chunks:
+            return
+        num += 1
+        yield num, StringIO.StringIO(''.join(chunks)), part_size - remaining
+
+
+def upload_part(bucket_name, key_name, upload_id, num, fp, size, retries):
+    "Upload one part on this thread's connection, retrying just that part with backoff."
+    for attempt in range(retries + 1):
+        try:
+            fp.seek(0)
+            mp = MultiPartUpload(s3_conn().get_bucket(bucket_name, validate=False))
+            mp.key_name = key_name
+            mp.id = upload_id
+            mp.upload_part_from_file(fp, num, size=size)
+            return num
+        except Exception:
+            if attempt == retries:
+                raise
+            _local.conn = None
+            time.sleep(2 ** attempt)
+
+
+def multipart_upload(bucket, key_name, parts, workers=4, retries=3, policy=None):
+    """Upload parts to key_name concurrently on a thread pool.
+
+    Only a few parts more than there are workers are in memory at once, so a
+    stream of any length can be uploaded. Any failure cancels the upload.
+    With no parts at all, e.g. an empty stdin, an empty key is written
+    instead, since S3 will not complete a multipart upload without parts.
+    """
+    parts = iter(parts)
+    first = next(parts, None)
+    if first is None:
+        k = Key(bucket, key_name)
+        k.set_contents_from_string('', policy=policy)
+        return k
+
+    mp = bucket.initiate_multipart_upload(key_name, policy=policy)
+    pool = ThreadPool(workers)
+    slots = threading.BoundedSemaphore(workers + 1)
+    errors = []
+
+    def finish(outcome, fp):
+        fp.close()
+        if not outcome[0]:
+            errors.append(outcome[1])
+        slots.release()
+
+    try:
+        for num, fp, size in chain([first], parts):
+            slots.acquire()
+            if errors:
+                fp.close()
+                break
+            pool.apply_async(timed, [upload_part, [bucket.name, key_name, mp.id, num, fp, size, retries], {}],
+                             callback=lambda outcome, fp=fp: finish(outcome, fp))
+        pool.close()
+        pool.join()
+        if errors:
+            raise RuntimeError('Unable to upload %s!\n%s' % (key_name, errors[0]))
+        mp.complete_upload()
+    except BaseException:
+        pool.terminate()
+        mp.cancel_upload()
+        raise
+    return Key(bucket, key_name)
+
+
+def upload_file(bucket, key_name, filename, policy=None, part_size=PART_SIZE, workers=4, retries=3):
+    "Upload filename to bucket as key_name, in parallel parts if it is bigger than one part; returns the key."
+    if os.path.getsize(filename) > part_size:
+        return multipart_upload(bucket, key_name, file_parts(filename, part_size), workers, retries, policy)
+    k = Key(bucket)
+    k.key = key_name
+    k.set_contents_from_filename(filename, policy=policy)
+    return k
 
 
 class CreateBucket(BaseCommand):
@@ -59,25 +185,87 @@ class Download(BaseCommand):
 
 
 class Upload(BaseCommand):
-    "Upload a file to S3."
+    "Upload a file, or stdin with -, to S3."
 
     def get_parser(self, prog_name):
         parser = super(Upload, self).get_parser(prog_name)
+        parser.add_argument('--part-size', type=int, default=PART_SIZE / MB, metavar='MB')
+        parser.add_argument('--public', action='store_true')
+        parser.add_argument('--retries', type=int, default=3)
+        parser.add_argument('-w', '--workers', type=int, default=4)
         parser.add_argument('bucket_name')
-        parser.add_argument('filename')
+        parser.add_argument('names', nargs='+', metavar='[key_name] filename')
         return parser
 
     def take_action(self, parsed_args):
+        if len(parsed_args.names) > 2:
+            raise RuntimeError('Give a file name, or a key name and a file name!')
+        filename = parsed_args.names[-1]
+        key_name = parsed_args.names[0]
+        if filename == '-' and len(parsed_args.names) == 1:
+            raise RuntimeError('A key name is needed to upload stdin!')
+        if filename != '-' and not os.path.exists(filename):
+            raise RuntimeError('File not found!')
+        part_size = parsed_args.part_size * MB
+        if part_size < MIN_PART_SIZE:
+            raise RuntimeError('Parts must be at least %d MB!' % (MIN_PART_SIZE / MB))
+
         bucket = self.app.s3_conn.get_bucket(parsed_args.bucket_name, validate=False)
         if not bucket:
             raise RuntimeError('Bucket not found!')
-        if not os.path.exists(parsed_args.filename):
+
+        public = parsed_args.public
+        if not public and filename != '-':
+            public_choice = raw_input('Make file publicly accessible? ')
+            public = public_choice.lower() in ['y', 'yes']
+        policy = 'public-read' if public else 'bucket-owner-full-control'
+
+        if filename == '-':
+            multipart_upload(bucket, key_name, stream_parts(sys.stdin, part_size),
+                             parsed_args.workers, parsed_args.retries, policy)
+        else:
+            upload_file(bucket, key_name, filename, policy, part_size, parsed_args.workers, parsed_args.retries)
+
+
+class Distribute(FleetCommand):
+    "Upload a file to S3 once and have every instance download it."
+
+    def get_parser(self, prog_name):
+        parser = super(Distribute, self).get_parser(prog_name)
+        parser.add_argument('-y', dest='assume_yes', action='store_true')
+        parser.add_argument('--to', default='')
+        parser.add_argument('--expires', type=int, default=3600)
+        parser.add_argument('--cleanup', action='store_true')
+        parser.add_argument('bucket_name')
+        parser.add_argument('filename')
+        return parser
+
+    def take_action(self, parsed_args):
+        if not os.path.isfile(parsed_args.filename):
             raise RuntimeError('File not found!')
+        bucket = self.app.s3_conn.get_bucket(parsed_args.bucket_name, validate=False)
+        if not bucket:
+            raise RuntimeError('Bucket not found!')
+
+        instances = self.get_targets(parsed_args)
+        if not (parsed_args.assume_yes or self.sure_targets(instances)):
+            return
 
-        k = Key(bucket)
-        k.key = parsed_args.filename
-        k.set_contents_from_filename(parsed_args.filename)
-        k.set_acl('bucket-owner-full-control')
-        public_choice = raw_input('Make file publicly accessible? ')
-        if public_choice.lower() in ['y', 'yes']:
-            k.set_acl('public-read')
+        # keyed by content, so distributing the same file again skips the upload
+        base = os.path.basename(parsed_args.filename)
+        key_name = 'clifford/%s/%s' % (local_digest(parsed_args.filename), base)
+        key = bucket.get_key(key_name)
+        if key is None or key.size != os.path.getsize(parsed_args.filename):
+            self.app.stdout.write('Uploading to s3://%s/%s\n' % (bucket.name, key_name))
+            key = upload_file(bucket, key_name, parsed_args.filename)
+        else:
+            self.app.stdout.write('Already in s3://%s/%s\n' % (bucket.name, key_name))
+
+        url = key.generate_url(parsed_args.expires)
+        target = posixpath.join(parsed_args.to, base)
+        try:
+            self.fan_out(instances, lambda instance, out: out.write(describe_transfer(
+                fetch(self.get_remote(instance), url, parsed_args.filename, target))), parsed_args.workers)
+        finally:
+            if parsed_args.cleanup:
+                key.delete()
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import pipes
+import posixpath
+import threading
+from collections import namedtuple
+
+
+CHUNK_SIZE = 32768
+
+Transfer = namedtuple('Transfer', ['source', 'target', 'status', 'sent'])
+
+_digests = {}
+_digests_lock = threading.Lock()
+
+
+def local_digest(path, length=None):
+    "sha1 of the first `length` bytes of path, or of all of it; whole-file digests are kept until the file changes."
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if length is None:
+        with _digests_lock:
+            if key in _digests:
+                return _digests[key]
+    sha1 = hashlib.sha1()
+    remaining = stat.st_size if length is None else length
+    with open(path, 'rb') as f:
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            sha1.update(chunk)
+            remaining -= len(chunk)
+    if length is None:
+        with _digests_lock:
+            _digests[key] = sha1.hexdigest()
+    return sha1.hexdigest()
+
+
+def remote_state(host, path, size=None, sudo=False):
+    """(size, sha1) of a remote file in one command, or (None, None) if there is none.
+
+    With size given the file is only hashed when its size matches.
+    """
+    names = {'path': pipes.quote(path), 'sudo': 'sudo ' if sudo else '', 'size': size}
+    cmd = 'size=$(%(sudo)sstat -c %%s %(path)s 2>/dev/null) && echo $size' % names
+    if size is not None:
+        cmd += ' && [ "$size" = %(size)d ]' % names
+    cmd += ' && %(sudo)ssha1sum %(path)s' % names
+    result = host.run(cmd)
+    if not result.stdout:
+        return None, None
+    remote_size = int(result.stdout[0])
+    digest = result.stdout[1].split()[0] if len(result.stdout) > 1 else None
+    return remote_size, digest
+
+
+def push(host, source, target, mode=None, owner=None):
+    """Copy a local file to host over SFTP unless an identical copy is already there.
+
+    The file is written to target.part and renamed into place, so an
+    interrupted copy is picked up where it stopped the next time. With an
+    owner the file is staged in the login's home and installed with sudo,
+    and a target under ~/ goes into the owner's home.
+    Returns a Transfer whose status is 'unchanged', 'sent' or 'resumed'.
+    """
+    size = os.path.getsize(source)
+    if mode is None:
+        mode = os.stat(source).st_mode & 0o777
+    if owner and target.startswith('~/'):
+        target = posixpath.join('/home', owner, target[2:])
+
+    remote_size, digest = remote_state(host, target, size, sudo=bool(owner))
+    if digest == local_digest(source):
+        return Transfer(source, target, 'unchanged', 0)
+
+    if owner:
+        upload = '.clifford-%s' % hashlib.sha1(target).hexdigest()[:12]
+    else:
+        upload = target
+    part = upload + '.part'
+
+    offset = 0
+    part_size, part_digest = remote_state(host, part)
+    if part_size and part_size <= size and part_digest == local_digest(source, part_size):
+        offset = part_size
+
+    with host.sftp() as sftp:
+        f = sftp.open(part, 'r+b' if offset else 'wb')
+        try:
+            f.set_pipelined(True)
+            f.seek(offset)
+            with open(source, 'rb') as src:
+                src.seek(offset)
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        finally:
+            f.close()
+        sftp.chmod(part, mode)
+        sftp.posix_rename(part, upload)
+
+    if owner:
+        names = {'owner': owner, 'mode': mode, 'upload': pipes.quote(upload), 'target': pipes.quote(target)}
+        result = host.run('sudo install -o %(owner)s -g %(owner)s -m %(mode)o %(upload)s %(target)s && rm -f %(upload)s' % names)
+        if result.status:
+            raise RuntimeError('Unable to install %s: %s' % (target, ''.join(result.stderr).strip()))
+
+    return Transfer(source, target, 'resumed' if offset else 'sent', size - offset)
+
+
+def push_all(host, sources, directory='', owner=None):
+    "Push local files into directory on host, home by default, one after another on its connection."
+    return [push(host, source, posixpath.join(directory, os.path.basename(source)), owner=owner) for source in sources]
+
+
+def describe_transfer(transfer):
+    if transfer.status == 'unchanged':
+        return '%s -> %s: unchanged\n' % (transfer.source, transfer.target)
+    return '%s -> %s: %s %d bytes\n' % (transfer.source, transfer.target, transfer.status, transfer.sent)
+
+
+def fetch(host, url, source, target, mode=None):
+    """Have host download url into target, checked against the local copy at source.
+
+    An identical target is left alone. curl picks up a partial download where
+    it stopped, and the file only replaces target once its sha1 matches.
+    """
+    size = os.path.getsize(source)
+    digest = local_digest(source)
+    if mode is None:
+        mode = os.stat(source).st_mode & 0o777
+
+    remote_size, remote_digest = remote_state(host, target, size)
+    if remote_digest == digest:
+        return Transfer(source, target, 'unchanged', 0)
+
+    names = {'url': pipes.quote(url), 'part': pipes.quote(target + '.part'), 'target': pipes.quote(target),
+             'digest': digest, 'mode': mode}
+    result = host.run('curl -fsS --retry 3 -C - -o %(part)s %(url)s'
+                      ' && printf \'%%s  %%s\\n\' %(digest)s %(part)s | sha1sum -c --status'
+                      ' && chmod %(mode)o %(part)s && mv %(part)s %(target)s' % names)
+    if result.status:
+        host.run('rm -f %(part)s' % names)
+        raise RuntimeError('Unable to fetch %s: %s' % (target, ''.join(result.stderr).strip() or 'checksum mismatch'))
+    return Transfer(source, target, 'downloaded', size)
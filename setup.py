@@ -95,6 +95,7 @@ setup(
             'adduser = clifford.remote:AddUser',
 
             'cnct = clifford.actions:Cnct',
+            'exec = clifford.remote:Exec',
             'script = clifford.remote:Script',
             'copy = clifford.remote:CopyFile',
             'update = clifford.remote:Update',
@@ -120,6 +121,7 @@ setup(
             # S3
             'create bucket = clifford.storage:CreateBucket',
             'del bucket = clifford.storage:DeleteBucket',
+            'distribute = clifford.storage:Distribute',
             'download = clifford.storage:Download',
             'upload = clifford.storage:Upload',
             ],
@@ -0,0 +1,87 @@
+import unittest
+from collections import deque
+
+from clifford import apt
+from clifford.engine import CommandResult
+
+
+class FakeHost(object):
+    """Plays back apt's output like RemoteHost.run does: streamed line by line,
+    with only the last `keep` lines held in the result."""
+
+    def __init__(self, name, installed=(), install=(), simulate=None, status=100):
+        self.host = name
+        self.installed = installed
+        self.install = install
+        self.simulate = simulate or {}
+        self.status = status
+        self.commands = []
+
+    def run(self, command, forward_agent=False, stream=None, keep=None):
+        self.commands.append(command)
+        if command.startswith('dpkg-query'):
+            return CommandResult(self.host, command, 0, ['%s install ok installed\n' % package
+                                                         for package in self.installed], [])
+        if command.startswith('apt-get -s'):
+            errors = [line for package, line in self.simulate.items() if package in command.split()]
+            return CommandResult(self.host, command, 100 if errors else 0, [], errors)
+
+        kept = (deque(maxlen=keep), deque(maxlen=keep))
+        for line, is_stderr in self.install:
+            kept[is_stderr].append(line)
+            if stream:
+                stream(line, is_stderr)
+        return CommandResult(self.host, command, self.status if self.install else 0, list(kept[0]), list(kept[1]))
+
+
+class AptTest(unittest.TestCase):
+
+    def tearDown(self):
+        apt._installed.clear()
+
+    def test_installed_packages_are_skipped(self):
+        host = FakeHost('skip', installed=['gcc', 'make'])
+        result = apt.apt_install(host, 'gcc make')
+        self.assertEqual(result.status, 0)
+        self.assertEqual(result.stdout, ['Already installed, skipping: gcc make\n'])
+        self.assertEqual(host.commands, ["dpkg-query -W -f='${Package} ${Status}\\n'"])
+
+    def test_output_is_bounded_but_every_error_is_kept(self):
+        install = [('Unpacking %d\n' % i, False) for i in range(1000)]
+        install += [('E: Unable to locate package nosuch\n', True)]
+        install += [('W: noise %d\n' % i, True) for i in range(1000)]
+        host = FakeHost('bounded', install=install)
+        result = apt.apt_install(host, 'gcc nosuch')
+        self.assertEqual(len(result.stdout), apt.TAIL_LINES)
+        self.assertIn('E: Unable to locate package nosuch\n', result.stderr)
+        self.assertLessEqual(len(result.stderr), apt.TAIL_LINES + 1)
+
+    def test_errors_go_to_the_bundles_owning_the_package(self):
+        host = FakeHost('owned', install=[('E: Unable to locate package nosuch\n', True)])
+        result, failed = apt.install_bundles(host, [('dev', 'gcc'), ('extra', 'nosuch'), ('more', 'nosuch make')])
+        self.assertEqual(failed.keys(), ['extra', 'more'])
+        self.assertFalse([command for command in host.commands if command.startswith('apt-get -s')])
+
+    def test_errors_the_simulation_cannot_place_are_kept(self):
+        host = FakeHost('unplaced', install=[('E: Broken packages\n', True),
+                                             ('E: Sub-process /usr/bin/dpkg returned an error code (1)\n', True)],
+                        simulate={'libbad': 'E: Broken packages\n'})
+        result, failed = apt.install_bundles(host, [('dev', 'gcc'), ('bad', 'libbad')])
+        self.assertEqual(failed['bad'], ['E: Broken packages\n'])
+        self.assertEqual(failed['(all)'], ['E: Sub-process /usr/bin/dpkg returned an error code (1)\n'])
+        self.assertNotIn('dev', failed)
+
+    def test_a_failed_install_without_errors_still_fails(self):
+        host = FakeHost('silent', install=[('dpkg: warning\n', True)])
+        result, failed = apt.install_bundles(host, [('dev', 'gcc')])
+        self.assertEqual(failed.keys(), ['(all)'])
+
+    def test_a_clean_install_fails_nothing(self):
+        host = FakeHost('clean', install=[('Setting up gcc\n', False)], status=0)
+        result, failed = apt.install_bundles(host, [('dev', 'gcc make'), ('vcs', 'git')])
+        self.assertEqual(failed, {})
+        self.assertEqual(host.commands[-1], 'sudo apt-get -y install gcc make git')
+
+
+if __name__ == '__main__':
+    unittest.main()
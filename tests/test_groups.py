@@ -0,0 +1,57 @@
+import unittest
+
+from clifford.groups import compile_groups, describe_items, group_items
+
+
+BUNDLES = {
+    'dev': 'gcc make',
+    'libs': 'libxml2-dev make',
+    'vcs': 'git',
+}
+
+
+class CompileGroupsTest(unittest.TestCase):
+
+    def test_included_groups_are_flattened_once(self):
+        groups = {
+            'base': 'vcs $curl +nginx',
+            'web': [{'Type': 'group', 'Value': 'base'}, {'Type': 'bundle', 'Value': 'dev'},
+                    {'Type': 'group', 'Value': 'libs'}],
+            'libs': 'libs &base @node',
+        }
+        web = compile_groups(groups, BUNDLES)['web']
+        self.assertEqual(web.bundles, [('vcs', 'git'), ('packages', 'curl'), ('dev', 'gcc make'), ('libs', 'libxml2-dev make')])
+        self.assertEqual(web.packages, ['git', 'curl', 'gcc', 'make', 'libxml2-dev'])
+        self.assertEqual(web.apt_repos, ['nginx'])
+        self.assertEqual(web.ppas, ['node'])
+        self.assertEqual(web.missing, [])
+
+    def test_missing_bundles_and_groups_are_reported(self):
+        compiled = compile_groups({'web': 'dev nosuch &gone'}, BUNDLES)
+        self.assertEqual(compiled['web'].missing, ['nosuch', '&gone'])
+
+    def test_loops_are_rejected_with_their_path(self):
+        groups = {'web': '&base', 'base': '&top dev', 'top': '&web'}
+        with self.assertRaises(RuntimeError) as raised:
+            compile_groups(groups, BUNDLES)
+        self.assertIn('web -> base -> top -> web', str(raised.exception))
+
+    def test_a_group_including_itself_is_a_loop(self):
+        self.assertRaises(RuntimeError, compile_groups, {'web': 'dev &web'}, BUNDLES)
+
+    def test_fixing_a_loop_compiles_again(self):
+        groups = {'web': '&base', 'base': '&web'}
+        self.assertRaises(RuntimeError, compile_groups, groups, BUNDLES)
+        groups['base'] = 'dev'
+        self.assertEqual(compile_groups(groups, BUNDLES)['web'].packages, ['gcc', 'make'])
+
+    def test_both_item_forms_describe_alike(self):
+        structured = [{'Type': 'bundle', 'Value': 'dev'}, {'Type': 'group', 'Value': 'base'},
+                      {'Type': 'packages', 'Value': 'curl wget'}, {'Type': 'ppa', 'Value': 'node'}]
+        self.assertEqual(describe_items(structured), 'dev &base $curl $wget @node')
+        self.assertEqual(group_items('dev &base $curl @node'),
+                         [('bundle', 'dev'), ('group', 'base'), ('packages', 'curl'), ('ppa', 'node')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loads the config the way main() does, then the modules commands pull in.
+STARTUP = '''
+import sys
+from clifford import main
+main.config = main.read_config(sys.argv[1])
+from clifford import engine, pipeline, runlog
+assert engine.config is main.config, 'engine bound config before it was read'
+assert runlog.config is main.config, 'runlog bound config before it was read'
+assert pipeline.config is main.config, 'pipeline bound config before it was read'
+engine.remote_engine()
+runlog.run_log()
+'''
+
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix='clifford-test-')
+        with open(os.path.join(ROOT, 'config.sample')) as f:
+            config = json.load(f)
+        config['LogPath'] = os.path.join(self.home, 'logs')
+        self.config_file = os.path.join(self.home, 'config.json')
+        with open(self.config_file, 'w') as f:
+            json.dump(config, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def start(self, config_file):
+        path = [ROOT] + ([os.environ['PYTHONPATH']] if os.environ.get('PYTHONPATH') else [])
+        env = dict(os.environ, HOME=self.home, PYTHONPATH=os.pathsep.join(path))
+        proc = subprocess.Popen([sys.executable, '-c', STARTUP, config_file],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = proc.communicate()
+        return proc.returncode, err
+
+    def test_modules_see_the_config_main_read(self):
+        status, err = self.start(self.config_file)
+        self.assertEqual(status, 0, err)
+
+    def test_a_group_loop_does_not_stop_the_config_loading(self):
+        with open(self.config_file) as f:
+            config = json.load(f)
+        config['Groups'] = {'web': '&base', 'base': '&web'}
+        with open(self.config_file, 'w') as f:
+            json.dump(config, f)
+        status, err = self.start(self.config_file)
+        self.assertEqual(status, 0, err)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import time
+import unittest
+
+from clifford.inventory import InstanceIndex, Inventory
+from clifford.query import Selector
+
+
+class FakeInstance(object):
+
+    def __init__(self, id, name, state='running', **tags):
+        self.id = id
+        self.state = state
+        self.public_dns_name = '%s.example.com' % id
+        self.private_ip_address = '10.0.0.1'
+        self.key_name = 'key'
+        self.image_id = 'ami-1'
+        self.tags = dict(tags, Name=name)
+
+
+class FakeConnection(object):
+    "Answers describes like EC2 does for the filters clifford pushes down, and counts them."
+
+    def __init__(self, instances):
+        self.instances = instances
+        self.describes = []
+
+    def get_all_reservations(self, filters=None, max_results=None, next_token=None):
+        self.describes.append(filters)
+        instances = self.instances
+        if 'instance-id' in filters:
+            instances = [inst for inst in instances if inst.id in filters['instance-id']]
+        if 'instance-state-name' in filters:
+            instances = [inst for inst in instances if inst.state in filters['instance-state-name']]
+        reservation = type('Reservation', (object,), {})()
+        reservation.instances = instances
+        return [reservation]
+
+
+class InventoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection([FakeInstance('i-1', 'web-1', Project='shop', Build='web'),
+                                    FakeInstance('i-2', 'web-2', Project='shop', Build='web'),
+                                    FakeInstance('i-3', 'db', 'stopped', Project='shop'),
+                                    FakeInstance('i-4', 'web-3', 'terminated', Project='shop', Build='web')])
+        self.inventory = Inventory(self.conn, ':memory:', 300)
+
+    def ids(self, selector):
+        return sorted(record.id for record in self.inventory.records(selector))
+
+    def test_every_state_is_cached(self):
+        self.assertEqual(self.ids(Selector(base_names=['web'], states=None)), ['i-1', 'i-2', 'i-4'])
+        self.assertEqual(self.ids(Selector(ids=['i-4'], states=None)), ['i-4'])
+
+    def test_selector_states_still_apply(self):
+        self.assertEqual(self.ids(Selector(base_names=['web'])), ['i-1', 'i-2'])
+        self.assertEqual(self.ids(Selector(project='shop', states=['stopped'])), ['i-3'])
+
+    def test_records_come_from_the_cache_within_the_ttl(self):
+        self.ids(Selector(project='shop'))
+        self.ids(Selector(build='web'))
+        self.ids(Selector(names=['db']))
+        self.assertEqual(len(self.conn.describes), 1)
+
+    def test_stale_inventory_is_described_again(self):
+        self.ids(Selector())
+        with self.inventory.db:
+            self.inventory.db.execute("UPDATE meta SET value = ? WHERE key = 'refreshed'", (repr(time.time() - 301),))
+        self.conn.instances[0].state = 'stopped'
+        self.assertEqual(self.ids(Selector(states=['stopped'])), ['i-1', 'i-3'])
+        self.assertEqual(len(self.conn.describes), 2)
+
+    def test_invalidated_instances_are_described_by_id(self):
+        self.ids(Selector())
+        self.conn.instances[1].state = 'stopped'
+        self.inventory.invalidate(['i-2'])
+        self.assertEqual(self.ids(Selector(states=['stopped'])), ['i-2', 'i-3'])
+        self.assertEqual(self.conn.describes[-1]['instance-id'], ['i-2'])
+        self.assertNotIn('instance-state-name', self.conn.describes[-1])
+
+    def test_disabled_inventory_describes_every_time(self):
+        self.inventory = Inventory(self.conn, ':memory:', 0)
+        self.assertEqual(self.ids(Selector(names=['db'])), ['i-3'])
+        self.assertEqual(self.ids(Selector(names=['db'])), ['i-3'])
+        self.assertEqual(len(self.conn.describes), 2)
+
+    def test_index_resolves_terminated_instances_by_name(self):
+        index = InstanceIndex(self.inventory)
+        self.assertEqual([record.id for record in index.select(Selector(names=['web-3'], states=None))], ['i-4'])
+        self.assertEqual(index.select(Selector(names=['web-3'])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from clifford import runlog
+from clifford.activity import Task
+from clifford.inventory import InstanceRecord
+from clifford.pipeline import Scheduler
+
+
+class Steps(object):
+    "Step functions that record what ran and how many ran at once."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ran = []
+        self.running = 0
+        self.most = 0
+
+    def step(self, fail=False):
+        def run(aws_key_path, task):
+            with self.lock:
+                self.running += 1
+                self.most = max(self.most, self.running)
+            time.sleep(0.05)
+            with self.lock:
+                self.running -= 1
+                self.ran.append(task.instance_id)
+            if fail:
+                raise RuntimeError('%s broke' % task.instance_id)
+            return 'ok %s\n' % task.instance_id
+        return run
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_path = tempfile.mkdtemp(prefix='clifford-test-')
+        self.saved_log = runlog._run_log
+        runlog._run_log = runlog.RunLog(self.log_path, StringIO.StringIO())
+        self.pool = ThreadPool(4)
+        self.steps = Steps()
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+        runlog._run_log = self.saved_log
+        shutil.rmtree(self.log_path)
+
+    def scheduler(self, limits=None):
+        return Scheduler(self.pool, '', StringIO.StringIO(), limits)
+
+    def add(self, scheduler, inst_id, steps):
+        scheduler.gate((inst_id, 'ready'))
+        scheduler.add_chain(inst_id, steps, Task({}, {}, inst_id, []), after=[(inst_id, 'ready')])
+
+    def test_a_failure_skips_only_the_rest_of_its_instance(self):
+        scheduler = self.scheduler()
+        for inst_id in ['i-1', 'i-2', 'i-3']:
+            self.add(scheduler, inst_id, [('a', self.steps.step(), []),
+                                          ('b', self.steps.step(fail=inst_id == 'i-2'), []),
+                                          ('c', self.steps.step(), [])])
+            scheduler.release((inst_id, 'ready'))
+
+        self.assertFalse(scheduler.run())
+        self.assertEqual(scheduler.failed, set([('i-2', 'b'), ('i-2', 'c')]))
+        self.assertEqual(sorted(self.steps.ran), ['i-1'] * 3 + ['i-2'] * 2 + ['i-3'] * 3)
+
+    def test_a_failed_gate_skips_the_whole_chain(self):
+        scheduler = self.scheduler()
+        self.add(scheduler, 'i-1', [('a', self.steps.step(), [])])
+        self.add(scheduler, 'i-2', [('a', self.steps.step(), [])])
+        scheduler.release(('i-1', 'ready'))
+        scheduler.release(('i-2', 'ready'), False, 'i-2 not found\n')
+
+        self.assertFalse(scheduler.run())
+        self.assertEqual(self.steps.ran, ['i-1'])
+        self.assertIn(('i-2', 'a'), scheduler.failed)
+
+    def test_limits_cap_a_step_across_instances(self):
+        scheduler = self.scheduler({'a': 1})
+        for inst_id in ['i-1', 'i-2', 'i-3', 'i-4']:
+            self.add(scheduler, inst_id, [('a', self.steps.step(), [])])
+            scheduler.release((inst_id, 'ready'))
+
+        self.assertTrue(scheduler.run())
+        self.assertEqual(self.steps.most, 1)
+        self.assertEqual(len(self.steps.ran), 4)
+
+    def test_steps_without_a_limit_overlap(self):
+        scheduler = self.scheduler()
+        for inst_id in ['i-1', 'i-2', 'i-3']:
+            self.add(scheduler, inst_id, [('a', self.steps.step(), [])])
+            scheduler.release((inst_id, 'ready'))
+
+        self.assertTrue(scheduler.run())
+        self.assertGreater(self.steps.most, 1)
+
+    def test_depend_waits_on_another_instance(self):
+        scheduler = self.scheduler()
+        self.add(scheduler, 'i-1', [('a', self.steps.step(), [])])
+        self.add(scheduler, 'i-2', [('a', self.steps.step(), [])])
+        scheduler.depend(('i-2', 'a'), [('i-1', 'a')])
+        scheduler.release(('i-2', 'ready'))
+        scheduler.release(('i-1', 'ready'))
+
+        self.assertTrue(scheduler.run())
+        self.assertEqual(self.steps.ran, ['i-1', 'i-2'])
+
+    def test_releasing_with_a_record_updates_the_waiting_steps(self):
+        seen = []
+
+        def connect(aws_key_path, task):
+            seen.append(task.instance.public_dns_name)
+            return 'connected to %s\n' % task.instance.public_dns_name
+
+        scheduler = self.scheduler()
+        pending = InstanceRecord('i-1', 'web-1', 'pending', '', '', 'key', 'ami-1', {'Name': 'web-1'})
+        running = InstanceRecord('i-1', 'web-1', 'running', 'web-1.example.com', '10.0.0.1', 'key', 'ami-1', {'Name': 'web-1'})
+        scheduler.gate(('i-1', 'ready'))
+        scheduler.add_chain('i-1', [('a', connect, []), ('b', connect, [])], Task({}, {}, 'i-1', [], pending),
+                            after=[('i-1', 'ready')])
+        scheduler.release(('i-1', 'ready'), instance=running)
+
+        self.assertTrue(scheduler.run())
+        self.assertEqual(seen, ['web-1.example.com'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import StringIO
+import threading
+import unittest
+
+from clifford import storage
+
+
+class FakeKey(object):
+    written = []
+
+    def __init__(self, bucket=None, name=None):
+        self.bucket = bucket
+        self.key = name
+
+    def set_contents_from_string(self, contents, policy=None):
+        FakeKey.written.append((self.key, contents, policy))
+
+
+class FakeUpload(object):
+
+    def __init__(self, key_name):
+        self.key_name = key_name
+        self.id = 'upload-1'
+        self.completed = False
+        self.cancelled = False
+
+    def complete_upload(self):
+        self.completed = True
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class FakeBucket(object):
+    name = 'bucket'
+
+    def __init__(self):
+        self.uploads = []
+
+    def initiate_multipart_upload(self, key_name, policy=None):
+        self.uploads.append(FakeUpload(key_name))
+        return self.uploads[-1]
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = storage.Key, storage.upload_part
+        storage.Key = FakeKey
+        FakeKey.written = []
+        self.lock = threading.Lock()
+        self.parts = {}
+        self.bucket = FakeBucket()
+
+    def tearDown(self):
+        storage.Key, storage.upload_part = self.saved
+
+    def upload_part(self, bucket_name, key_name, upload_id, num, fp, size, retries):
+        fp.seek(0)
+        with self.lock:
+            self.parts[num] = fp.read(size)
+        return num
+
+    def test_a_stream_is_uploaded_in_parts(self):
+        storage.upload_part = self.upload_part
+        data = ''.join(chr(i % 256) for i in range(2500))
+        key = storage.multipart_upload(self.bucket, 'data.bin', storage.stream_parts(StringIO.StringIO(data), 1000), workers=2)
+        self.assertEqual(key.key, 'data.bin')
+        self.assertEqual(sorted(self.parts), [1, 2, 3])
+        self.assertEqual(''.join(self.parts[num] for num in sorted(self.parts)), data)
+        self.assertTrue(self.bucket.uploads[0].completed)
+
+    def test_empty_input_writes_an_empty_key(self):
+        storage.upload_part = self.upload_part
+        key = storage.multipart_upload(self.bucket, 'empty', storage.stream_parts(StringIO.StringIO(''), 1000),
+                                       policy='private')
+        self.assertEqual(key.key, 'empty')
+        self.assertEqual(FakeKey.written, [('empty', '', 'private')])
+        self.assertEqual(self.bucket.uploads, [])
+
+    def test_a_failed_part_cancels_the_upload(self):
+        def upload_part(bucket_name, key_name, upload_id, num, fp, size, retries):
+            if num == 2:
+                raise IOError('connection reset')
+            return self.upload_part(bucket_name, key_name, upload_id, num, fp, size, retries)
+
+        storage.upload_part = upload_part
+        with self.assertRaises(RuntimeError) as raised:
+            storage.multipart_upload(self.bucket, 'data.bin', storage.stream_parts(StringIO.StringIO('x' * 5000), 1000),
+                                     workers=1)
+        self.assertIn('connection reset', str(raised.exception))
+        self.assertTrue(self.bucket.uploads[0].cancelled)
+        self.assertFalse(self.bucket.uploads[0].completed)
+
+
+if __name__ == '__main__':
+    unittest.main()